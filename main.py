@@ -1,15 +1,44 @@
+import importlib
 import logging
 import os
+import typing
 
 import typer
-
-from src import run
+import typer.core
+import typer.main
 
 logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-app = typer.Typer()
-app.add_typer(run.app, name="run")
+
+
+class LazyGroup(typer.core.TyperGroup):
+    """
+    Import sub-apps only when they are invoked, keep `version` and health checks fast
+    """
+
+    lazy_apps: typing.ClassVar[dict[str, str]] = {"disk": "src.disk", "run": "src.run"}
+
+    def list_commands(self, ctx):
+        return [*super().list_commands(ctx), *sorted(self.lazy_apps)]
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_apps and cmd_name not in self.commands:
+            module = importlib.import_module(self.lazy_apps[cmd_name])
+            cmd = typer.main.get_command(module.app)
+            cmd.name = cmd_name
+            self.add_command(cmd)
+        return super().get_command(ctx, cmd_name)
+
+
+app = typer.Typer(cls=LazyGroup)
+
+
+@app.callback()
+def main():
+    """
+    Run VM in container
+    """
 
 
 @app.command()
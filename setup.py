@@ -10,6 +10,7 @@ extras_require = {
         "mypy",
         "pytest",
         "pytest-cov",
+        "pytest-benchmark",
     ],
     "build": ["pyinstaller", "pyinstaller-hooks-contrib"],
 }
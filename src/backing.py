@@ -0,0 +1,184 @@
+import logging
+import os
+import stat
+
+from . import meta, qcow2, utils
+
+log = logging.getLogger(__name__)
+
+BASE_DIR = os.path.join(meta.STORAGE_DIR, "base")
+REFS_FILE = os.path.join(BASE_DIR, "refs.json")
+MAX_CHAIN_DEPTH = 16
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def resolve(base: str) -> str:
+    """
+    The absolute path of a base image, names are looked up in BASE_DIR
+    """
+    if os.sep not in base:
+        base = os.path.join(BASE_DIR, base)
+    base = os.path.abspath(base)
+    if not os.path.isfile(base):
+        raise FileNotFoundError(f"base image {base} not found")
+    return base
+
+
+def image_format(file: str) -> str:
+    return "qcow2" if qcow2.read_info(file) else "raw"
+
+
+def _backing_path(file: str, info: qcow2.Info) -> str | None:
+    if not info.backing_file:
+        return None
+    # Qemu resolves relative backing files against the image
+    return os.path.join(os.path.dirname(os.path.abspath(file)), info.backing_file)
+
+
+def backing_chain(file: str) -> list[str]:
+    """
+    `file` and its backing files down to the base, raise if the chain is broken
+    """
+    chain = [os.path.abspath(file)]
+    while (info := qcow2.read_info(chain[-1])) and (
+        backing := _backing_path(chain[-1], info)
+    ):
+        backing = os.path.normpath(backing)
+        if backing in chain:
+            raise EnvironmentError(f"backing chain of {file} loops at {backing}")
+        if len(chain) >= MAX_CHAIN_DEPTH:
+            raise EnvironmentError(f"backing chain of {file} is too deep")
+        if not os.path.isfile(backing):
+            raise EnvironmentError(f"backing file {backing} of {chain[-1]} is missing")
+        chain.append(backing)
+    return chain
+
+
+def _stamp(file: str) -> list[int]:
+    st = os.stat(file)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _live_overlays(base: str, overlays: list[str]) -> list[str]:
+    """
+    Overlays still backed by `base`, removed disks and rebased ones are dropped
+    """
+    live = []
+    for o in overlays:
+        info = qcow2.read_info(o)
+        backing = info and _backing_path(o, info)
+        if backing and os.path.normpath(backing) == base:
+            live.append(o)
+    return live
+
+
+def acquire(base: str, overlay: str) -> int:
+    """
+    Count `overlay` as a user of `base` and make `base` read-only, return the
+    number of its users. Raise if `base` was written since its users were counted,
+    their clusters no longer match it.
+    """
+    with utils.locked_json(REFS_FILE) as refs:
+        entry = refs.get(base) or {"stamp": _stamp(base), "overlays": []}
+        others = [o for o in _live_overlays(base, entry["overlays"]) if o != overlay]
+        if others and entry["stamp"] != _stamp(base):
+            raise EnvironmentError(
+                f"base image {base} was modified while {len(others)} overlays "
+                "depend on it"
+            )
+        os.chmod(base, os.stat(base).st_mode & READ_ONLY)
+        entry["overlays"] = [*others, overlay]
+        entry["stamp"] = _stamp(base)
+        refs[base] = entry
+        return len(entry["overlays"])
+
+
+def release(overlay: str):
+    """
+    Stop counting `overlay` as a user of any base
+    """
+    with utils.locked_json(REFS_FILE) as refs:
+        for entry in refs.values():
+            entry["overlays"] = [o for o in entry["overlays"] if o != overlay]
+
+
+def users() -> dict[str, list[str]]:
+    """
+    The overlays of each base image
+    """
+    with utils.locked_json(REFS_FILE) as refs:
+        for base, entry in refs.items():
+            entry["overlays"] = _live_overlays(base, entry["overlays"])
+        return {base: list(e["overlays"]) for base, e in refs.items()}
+
+
+def create_overlay(
+    base: str, overlay: str, size: str | None = None, opts: list[str] | None = None
+):
+    """
+    A qcow2 image reading unwritten clusters from `base`, it takes the size of
+    `base` unless `size` is given
+    """
+    os.makedirs(os.path.dirname(overlay), exist_ok=True)
+    log.info(f"Creating {overlay} backed by {base} ...")
+    argv = ["qemu-img", "create", "-f", "qcow2", "-b", base, "-F", image_format(base)]
+    if opts:
+        argv += ["-o", ",".join(opts)]
+    argv.append(overlay)
+    if size:
+        argv.append(size)
+    utils.sh(argv)
+
+
+def check_overlay(base: str, overlay: str):
+    """
+    Raise unless `overlay` is backed by `base` through a whole chain
+    """
+    chain = backing_chain(overlay)
+    if len(chain) < 2 or chain[1] != base:
+        raise EnvironmentError(
+            f"{overlay} is backed by {chain[1] if len(chain) > 1 else 'nothing'}, "
+            f"not {base}, use 'disk rebase' to change it"
+        )
+
+
+def rebase(overlay: str, base: str | None):
+    """
+    Back `overlay` by `base` keeping its content, or make it standalone
+    """
+    chain = backing_chain(overlay)
+    argv = ["qemu-img", "rebase", "-f", "qcow2", "-b", base or ""]
+    if base:
+        argv += ["-F", image_format(base)]
+    log.info(f"Rebasing {overlay} onto {base or 'nothing'} ...")
+    utils.sh(argv + [overlay])
+    release(overlay)
+    if base:
+        acquire(base, overlay)
+    elif len(chain) > 1:
+        log.info(f"{overlay} no longer depends on {chain[1]}")
+
+
+def commit(overlay: str):
+    """
+    Write the clusters of `overlay` into its base, only if nothing else uses it
+    """
+    chain = backing_chain(overlay)
+    if len(chain) < 2:
+        raise EnvironmentError(f"{overlay} has no base image")
+    base = chain[1]
+    with utils.locked_json(REFS_FILE) as refs:
+        entry = refs.get(base) or {"overlays": []}
+        others = [o for o in _live_overlays(base, entry["overlays"]) if o != overlay]
+        if others:
+            raise EnvironmentError(
+                f"base image {base} is shared by {len(others)} other overlays"
+            )
+        mode = os.stat(base).st_mode
+        os.chmod(base, mode | stat.S_IWUSR)
+        try:
+            log.info(f"Committing {overlay} into {base} ...")
+            utils.sh(["qemu-img", "commit", "-f", "qcow2", overlay])
+        finally:
+            os.chmod(base, mode)
+        refs[base] = {"stamp": _stamp(base), "overlays": [overlay]}
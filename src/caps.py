@@ -0,0 +1,143 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from . import host, meta, utils
+
+log = logging.getLogger(__name__)
+
+CAPS_FILE = os.path.join(meta.STORAGE_DIR, "caps.json")
+
+
+def find_qemu_binaries() -> dict[str, str]:
+    return host.current().qemu_binaries()
+
+
+def get_qemu_archs() -> list[str]:
+    return list(find_qemu_binaries())
+
+
+@functools.cache
+def cpu_flags() -> frozenset[str]:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return frozenset(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return frozenset()
+
+
+def is_kvm_avaliable():
+    return bool(cpu_flags() & {"vmx", "svm"})
+
+
+def host_key(arch: str) -> str | None:
+    """
+    Identity of the Qemu binary of `arch` and the host CPU, None if unknown
+    """
+    path = find_qemu_binaries().get(arch)
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    flags = hashlib.sha1(" ".join(sorted(cpu_flags())).encode()).hexdigest()
+    return f"{path}:{st.st_size}:{st.st_mtime_ns}:{flags[:12]}"
+
+
+def _load() -> dict:
+    try:
+        with open(CAPS_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(caps: dict):
+    try:
+        os.makedirs(os.path.dirname(CAPS_FILE), exist_ok=True)
+        tmp_file = f"{CAPS_FILE}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(caps, f, indent=2)
+        os.replace(tmp_file, CAPS_FILE)
+    except OSError as e:
+        log.warning(f"failed to save capability cache: {e}")
+
+
+_lock = threading.Lock()
+
+
+def _cached(name: str, arch: str, probe):
+    key = host_key(arch)
+    with host.unrecorded():
+        if key is None:  # unknown binary, let the probe report the error
+            return probe()
+        with _lock:
+            return _cached_locked(name, key, probe)
+
+
+def _cached_locked(name: str, key: str, probe):
+    caps = _load()
+    entry = caps.get(key, {})
+    if name not in entry:
+        entry[name] = probe()
+        # binaries of other versions are stale
+        caps = {k: v for k, v in caps.items() if not k.startswith(key.split(":")[0])}
+        caps[key] = entry
+        _save(caps)
+    return entry[name]
+
+
+def _probe_machines(arch: str) -> dict[str, list[str]]:
+    ret = utils.sh([f"qemu-system-{arch}", "-machine", "help"])
+    machines: dict[str, list[str]] = {"all": [], "active": []}
+    for line in ret.stdout.decode().splitlines()[1:]:
+        if not line.strip():
+            continue
+        name = line.split()[0]
+        machines["all"].append(name)
+        if "alias" in line:
+            machines["active"].append(name)
+    return machines
+
+
+def get_qemu_machines(arch: str, active_only=False) -> list[str]:
+    machines = _cached("machines", arch, lambda: _probe_machines(arch))
+    return machines["active" if active_only else "all"]
+
+
+def _probe_accels(arch: str) -> list[str]:
+    ret = utils.sh([f"qemu-system-{arch}", "-accel", "help"])
+    lines = ret.stdout.decode().splitlines()[1:]  # skip the header
+    return [line.strip() for line in lines if line.strip()]
+
+
+def get_qemu_accels(arch: str) -> list[str]:
+    return _cached("accels", arch, lambda: _probe_accels(arch))
+
+
+def _probe_io_uring(arch: str) -> bool:
+    with tempfile.NamedTemporaryFile() as f:
+        blockdev = f"driver=file,node-name=probe,filename={f.name},aio=io_uring"
+        ret = utils.sh(
+            [f"qemu-system-{arch}", "-machine", "none", "-nodefaults"]
+            + ["-display", "none", "-blockdev", blockdev, "-qmp", "stdio"],
+            input=b'{"execute": "qmp_capabilities"}\n{"execute": "quit"}\n',
+            check=False,
+        )
+    return ret.returncode == 0
+
+
+def is_io_uring_supported(arch: str) -> bool:
+    """
+    Whether Qemu can open a drive with 'aio=io_uring', it needs a Qemu built with
+    liburing and a kernel (and seccomp profile) allowing io_uring
+    """
+    return _cached("io_uring", arch, lambda: _probe_io_uring(arch))
@@ -0,0 +1,186 @@
+import asyncio
+import contextlib
+import logging
+import os
+
+from . import backing, meta, qcow2, qmp, service, utils
+
+log = logging.getLogger(__name__)
+
+FSTRIM_TIMEOUT = 600  # seconds, the guest trims every mounted filesystem
+# free ranges smaller than this are left to the guest, fewer discards to serve
+FSTRIM_MINIMUM = 1 << 20
+IDLE_WINDOW = 60  # seconds of block I/O sampled before a background trim
+IDLE_OPS = 100  # read+write requests within the window to count as idle
+
+
+def allocated(file: str) -> int:
+    """
+    Bytes the image takes on the storage, holes excluded
+    """
+    return os.stat(file).st_blocks * 512
+
+
+def _qmp(qmp_port: int) -> qmp.Qmp | None:
+    try:
+        return qmp.Qmp(("127.0.0.1", qmp_port))
+    except OSError:
+        return None
+
+
+def _is_attached(q: qmp.Qmp, file: str) -> bool:
+    for dev in q.execute("query-block"):
+        image = dev.get("inserted", {}).get("image", {})
+        if image.get("filename") == file:
+            return True
+    return False
+
+
+def trim(agent: str = meta.GUEST_AGENT_SOCKET, minimum=FSTRIM_MINIMUM) -> list[dict]:
+    """
+    Ask the guest to discard the free space of its filesystems, the results of
+    each mount point are returned
+    """
+    with qmp.GuestAgent(agent) as ga:
+        ga.settimeout(FSTRIM_TIMEOUT)
+        ret = ga.execute("guest-fstrim", minimum=minimum)
+    paths = ret.get("paths", [])
+    for p in paths:
+        if "error" in p:
+            log.warning(f"fstrim of {p.get('path')} failed in the guest: {p['error']}")
+    return paths
+
+
+def rewrite(file: str, compress=False, rate: int | None = None):
+    """
+    Copy `file` without its zero and discarded clusters and swap it in, the image
+    must not be in use
+    """
+    info = qcow2.read_info(file)
+    if not info:
+        raise EnvironmentError(f"{file} isn't a qcow2 image")
+    opts = [f"cluster_size={info.cluster_size}"]
+    if info.extended_l2:
+        opts.append("extended_l2=on")
+    # the idle I/O class leaves the disk to running VMs
+    argv = ["ionice", "-c", "3", "nice", "-n", "19", "qemu-img", "convert"]
+    argv += ["-f", "qcow2", "-O", "qcow2", "-S", "4k", "-o", ",".join(opts)]
+    if compress:
+        argv.append("-c")
+    if rate:
+        argv += ["-r", str(rate)]
+    chain = backing.backing_chain(file)
+    if len(chain) > 1:  # keep the overlay on its base
+        argv += ["-B", chain[1], "-F", backing.image_format(chain[1])]
+    tmp_file = f"{file}.compact"
+    log.info(f"Rewriting {file} ...")
+    try:
+        utils.sh(argv + [file, tmp_file])
+        st = os.stat(file)
+        os.chmod(tmp_file, st.st_mode)
+        os.replace(tmp_file, file)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_file)
+
+
+def compact(
+    file: str,
+    compress=False,
+    rate: int | None = None,
+    qmp_port: int = meta.VmPort.QMP,
+    agent: str = meta.GUEST_AGENT_SOCKET,
+) -> int:
+    """
+    Return the free space of the disk `file` to the storage, by the guest agent
+    while the VM is running, otherwise by rewriting the image. Return the bytes
+    reclaimed.
+    """
+    before = allocated(file)
+    q = _qmp(qmp_port)
+    running = False
+    if q:
+        with q:
+            running = _is_attached(q, file)
+    if running:
+        try:
+            trim(agent)
+        except OSError as e:
+            raise EnvironmentError(
+                f"{file} is in use and the guest agent doesn't answer ({e}), "
+                "install qemu-guest-agent in the VM or stop it to compact offline"
+            ) from e
+    else:
+        rewrite(file, compress, rate)
+    reclaimed = before - allocated(file)
+    log.info(f"Compacted {file}, {reclaimed} bytes reclaimed")
+    return reclaimed
+
+
+class Compactor(service.LoopService):
+    """
+    Trim the running VM every `interval` seconds, if its disks were idle for a
+    while, so the guest's discards don't compete with its own I/O
+    """
+
+    name = "compactor"
+
+    def __init__(
+        self,
+        files: list[str],
+        interval: float,
+        qmp_port: int = meta.VmPort.QMP,
+        agent: str = meta.GUEST_AGENT_SOCKET,
+    ):
+        super().__init__()
+        self.files = files
+        self.interval = interval
+        self.qmp_port = qmp_port
+        self.agent = agent
+
+    def spec(self) -> dict:
+        return {
+            "name": self.name,
+            "files": self.files,
+            "interval": self.interval,
+            "qmp_port": self.qmp_port,
+            "agent": self.agent,
+        }
+
+    @classmethod
+    def from_spec(cls, spec: dict) -> "Compactor":
+        return cls(spec["files"], spec["interval"], spec["qmp_port"], spec["agent"])
+
+    def _setup(self, loop: asyncio.AbstractEventLoop):
+        self._spawn(self._run_periodically())
+
+    def _io_ops(self) -> int | None:
+        q = _qmp(self.qmp_port)
+        if not q:
+            return None
+        with q:
+            stats = q.execute("query-blockstats")
+        return sum(
+            s["stats"]["rd_operations"] + s["stats"]["wr_operations"] for s in stats
+        )
+
+    def _trim_once(self) -> int:
+        before = sum(allocated(f) for f in self.files)
+        trim(self.agent)
+        return before - sum(allocated(f) for f in self.files)
+
+    async def _run_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                start = await loop.run_in_executor(None, self._io_ops)
+                await asyncio.sleep(IDLE_WINDOW)
+                end = await loop.run_in_executor(None, self._io_ops)
+                if start is None or end is None or end - start > IDLE_OPS:
+                    log.info("VM disks are busy, compact them later")
+                    continue
+                reclaimed = await loop.run_in_executor(None, self._trim_once)
+                log.info(f"Background compaction reclaimed {reclaimed} bytes")
+            except (OSError, qmp.QmpError) as e:
+                log.warning(f"background compaction failed: {e}")
@@ -0,0 +1,225 @@
+import asyncio
+import ipaddress
+import logging
+import socket
+import struct
+import typing
+
+from . import service
+
+log = logging.getLogger(__name__)
+
+SERVER_PORT = 67
+CLIENT_PORT = 68
+IP_PKTINFO = getattr(socket, "IP_PKTINFO", 8)  # linux, not exported by python<3.12
+MAGIC_COOKIE = b"\x63\x82\x53\x63"
+HEADER = struct.Struct("!BBBBIHH4s4s4s4s16s64s128s4s")
+PKTINFO = struct.Struct("=I4s4s")  # ifindex, spec_dst, addr
+MIN_SIZE = 300  # bootp, older clients drop shorter replies
+INFINITE = 0xFFFFFFFF
+
+
+class MsgType:
+    DISCOVER = 1
+    OFFER = 2
+    REQUEST = 3
+    DECLINE = 4
+    ACK = 5
+    NAK = 6
+    RELEASE = 7
+
+
+class Opt:
+    NETMASK = 1
+    ROUTER = 3
+    DNS = 6
+    BROADCAST = 28
+    REQUESTED_IP = 50
+    LEASE_TIME = 51
+    MSG_TYPE = 53
+    SERVER_ID = 54
+    END = 255
+
+
+class Binding(typing.NamedTuple):
+    """
+    The static lease of a VM NIC
+    """
+
+    ip: ipaddress.IPv4Address
+    network: ipaddress.IPv4Network
+    router: ipaddress.IPv4Address | None = None
+    nameservers: tuple[str, ...] = ()
+
+
+class Message(typing.NamedTuple):
+    xid: int
+    flags: int
+    ciaddr: ipaddress.IPv4Address
+    giaddr: bytes
+    mac: str  # upper case, like the generated ones
+    options: dict[int, bytes]
+
+    @property
+    def type(self) -> int | None:
+        t = self.options.get(Opt.MSG_TYPE)
+        return t[0] if t else None
+
+
+def parse(data: bytes) -> Message | None:
+    """
+    A BOOTREQUEST from an ethernet client, or None
+    """
+    if len(data) < HEADER.size:
+        return None
+    op, htype, hlen, _, xid, _, flags, ciaddr, _, _, giaddr, chaddr, *_, magic = (
+        HEADER.unpack_from(data)
+    )
+    if op != 1 or htype != 1 or hlen != 6 or magic != MAGIC_COOKIE:
+        return None
+    options, i = {}, HEADER.size
+    while i < len(data) and data[i] != Opt.END:
+        if data[i] == 0:  # pad
+            i += 1
+            continue
+        if i + 1 >= len(data):
+            break
+        code, n = data[i], data[i + 1]
+        options[code] = options.get(code, b"") + data[i + 2 : i + 2 + n]
+        i += 2 + n
+    mac = ":".join(f"{b:02X}" for b in chaddr[:6])
+    return Message(xid, flags, ipaddress.IPv4Address(ciaddr), giaddr, mac, options)
+
+
+def build_reply(
+    msg: Message, msg_type: int, server_ip: ipaddress.IPv4Address, b: Binding | None
+) -> bytes:
+    yiaddr = b.ip.packed if b and msg_type != MsgType.NAK else bytes(4)
+    chaddr = bytes.fromhex(msg.mac.replace(":", "")).ljust(16, b"\0")
+    zero = bytes(4)
+    header = HEADER.pack(
+        *(2, 1, 6, 0, msg.xid, 0, msg.flags),
+        *(zero, yiaddr, zero, msg.giaddr, chaddr),
+        *(bytes(64), bytes(128), MAGIC_COOKIE),
+    )
+    options = [
+        (Opt.MSG_TYPE, bytes([msg_type])),
+        (Opt.SERVER_ID, server_ip.packed),
+    ]
+    if b and msg_type != MsgType.NAK:
+        options += [
+            (Opt.LEASE_TIME, struct.pack("!I", INFINITE)),
+            (Opt.NETMASK, b.network.netmask.packed),
+            (Opt.BROADCAST, b.network.broadcast_address.packed),
+        ]
+        if b.router:
+            options.append((Opt.ROUTER, b.router.packed))
+        if b.nameservers:
+            dns = b"".join(ipaddress.IPv4Address(n).packed for n in b.nameservers)
+            options.append((Opt.DNS, dns))
+    body = b"".join(bytes([code, len(v)]) + v for code, v in options)
+    return (header + body + bytes([Opt.END])).ljust(MIN_SIZE, b"\0")
+
+
+def reply_type(msg: Message, b: Binding, server_ip: ipaddress.IPv4Address):
+    """
+    The reply to `msg` from a known client, None to stay silent
+    """
+    server_id = msg.options.get(Opt.SERVER_ID)
+    if msg.type == MsgType.DISCOVER:
+        return MsgType.OFFER
+    if msg.type == MsgType.REQUEST:
+        if server_id and server_id != server_ip.packed:
+            return None  # the client took another offer
+        requested = msg.options.get(Opt.REQUESTED_IP) or msg.ciaddr.packed
+        if requested in (b.ip.packed, bytes(4)):
+            return MsgType.ACK
+        return MsgType.NAK
+    return None
+
+
+class DhcpServer(service.LoopService):
+    """
+    Answer DHCP for the static leases of the VM NICs, in place of dnsmasq.
+
+    One socket serves all interfaces, replies go out on the interface of the
+    request (IP_PKTINFO).
+    """
+
+    name = "dhcp"
+
+    def __init__(self, bindings: dict[str, Binding], bind: str = "0.0.0.0"):
+        super().__init__()
+        self.bindings = {mac.upper(): b for mac, b in bindings.items()}
+        self.bind = bind
+
+    def spec(self) -> dict:
+        bindings = {
+            mac: {
+                "ip": str(b.ip),
+                "network": str(b.network),
+                "router": str(b.router) if b.router else None,
+                "nameservers": list(b.nameservers),
+            }
+            for mac, b in self.bindings.items()
+        }
+        return {"name": self.name, "bindings": bindings, "bind": self.bind}
+
+    @classmethod
+    def from_spec(cls, spec: dict) -> "DhcpServer":
+        bindings = {
+            mac: Binding(
+                ip=ipaddress.IPv4Address(b["ip"]),
+                network=ipaddress.IPv4Network(b["network"]),
+                router=ipaddress.IPv4Address(b["router"]) if b["router"] else None,
+                nameservers=tuple(b["nameservers"]),
+            )
+            for mac, b in spec["bindings"].items()
+        }
+        return cls(bindings, bind=spec["bind"])
+
+    def _setup(self, loop: asyncio.AbstractEventLoop):
+        sock = self._socket(socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        sock.bind((self.bind, SERVER_PORT))
+        loop.add_reader(sock, self._on_request, sock)
+
+    def _on_request(self, sock: socket.socket):
+        while True:
+            try:
+                data, ancdata, _, _ = sock.recvmsg(
+                    2048, socket.CMSG_SPACE(PKTINFO.size)
+                )
+            except OSError:
+                return
+            msg = parse(data)
+            if not msg or not (b := self.bindings.get(msg.mac)):
+                continue
+            ifindex, spec_dst = 0, bytes(4)
+            for level, kind, cdata in ancdata:
+                if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                    ifindex, spec_dst, _ = PKTINFO.unpack_from(cdata)
+            server_ip = ipaddress.IPv4Address(spec_dst)
+            if not int(server_ip):
+                server_ip = b.router or next(b.network.hosts())
+            msg_type = reply_type(msg, b, server_ip)
+            if not msg_type:
+                continue
+            reply = build_reply(msg, msg_type, server_ip, b)
+            if msg_type == MsgType.ACK:
+                log.info(f"DHCP ack {b.ip} to {msg.mac}")
+            elif msg_type == MsgType.NAK:
+                log.info(f"DHCP nak to {msg.mac}, it asked for another address")
+            # the client has no address until it's bound, unless renewing
+            dest = str(msg.ciaddr) if int(msg.ciaddr) else "255.255.255.255"
+            pktinfo = PKTINFO.pack(ifindex, server_ip.packed, bytes(4))
+            try:
+                sock.sendmsg(
+                    [reply],
+                    [(socket.IPPROTO_IP, IP_PKTINFO, pktinfo)],
+                    0,
+                    (dest, CLIENT_PORT),
+                )
+            except OSError as e:
+                log.warning(f"failed to reply DHCP to {msg.mac}: {e}")
@@ -0,0 +1,67 @@
+import logging
+import os
+
+import click
+import typer
+
+from . import backing, compact, meta
+from .run import gen_disk_name
+
+log = logging.getLogger(__name__)
+
+app = typer.Typer(no_args_is_help=True)
+
+
+def _overlay(name: str) -> str:
+    file = os.path.join(meta.STORAGE_DIR, gen_disk_name(name))
+    if not os.path.exists(file):
+        raise click.UsageError(f"disk {file} not found")
+    return file
+
+
+@app.command()
+def refs():
+    """List base images and their overlays"""
+    for base, overlays in backing.users().items():
+        typer.echo(f"{base}: {len(overlays)} overlays")
+        for o in overlays:
+            typer.echo(f"  {o}")
+
+
+@app.command()
+def rebase(
+    name: str = typer.Option(..., "-n", "--name", help="Disk name (e.g. disk1)"),
+    base: str = typer.Option(
+        None, help="New base image, the disk becomes standalone if not set"
+    ),
+):
+    """Change the base image of a disk, keeping its content"""
+    if base:
+        try:
+            base = backing.resolve(base)
+        except FileNotFoundError as e:
+            raise click.UsageError(str(e)) from e
+    backing.rebase(_overlay(name), base)
+
+
+@app.command()
+def commit(
+    name: str = typer.Option(..., "-n", "--name", help="Disk name (e.g. disk1)"),
+):
+    """Write a disk into its base image, if no other disk uses the base"""
+    backing.commit(_overlay(name))
+
+
+@app.command("compact")
+def compact_disk(
+    name: str = typer.Option(..., "-n", "--name", help="Disk name (e.g. disk1)"),
+    compress: bool = typer.Option(False, help="Compress the rewritten image"),
+    rate: int = typer.Option(
+        None, min=1, help="Max MB/s of an offline rewrite [default: unlimited]"
+    ),
+):
+    """
+    Return the free space of a disk to the storage, by guest fstrim if the VM is
+    running, otherwise by rewriting the image
+    """
+    compact.compact(_overlay(name), compress, rate and rate << 20)
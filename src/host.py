@@ -0,0 +1,223 @@
+import contextlib
+import functools
+import glob
+import json
+import os
+import pathlib
+import socket
+import stat
+import subprocess
+import threading
+import time
+
+from . import netinfo, scan
+
+QEMU_SYSTEM_PREFIX = "qemu-system-"
+
+
+class Host:
+    """
+    Everything the startup path does to the machine: spawning commands, reading the
+    network inventory, probing addresses and creating device files.
+
+    The default implementation acts on the real host, tests and benchmarks swap it
+    with `set_host` to run offline.
+    """
+
+    def run(self, args, **kwargs) -> subprocess.CompletedProcess:
+        return subprocess.run(args, check=kwargs.pop("check", False), **kwargs)
+
+    def inventory(self) -> netinfo.Inventory:
+        return netinfo.scan()
+
+    def probe(self, ips: list[str], iface: str | None = None) -> set[str]:
+        return scan.probe(ips, iface)
+
+    def qemu_binaries(self) -> dict[str, str]:
+        """
+        Map arch to 'qemu-system-<arch>' path
+        """
+        return _find_qemu_binaries(os.environ.get("PATH", ""))
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(path)
+
+    def write_file(self, path: str, content: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def mknod(self, path: str, mode: int, major: int, minor: int):
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        os.mknod(path, stat.S_IFCHR | mode, os.makedev(major, minor))
+        os.chmod(path, mode)  # ignore umask
+
+    def remove(self, path: str):
+        os.remove(path)
+
+    def open_device(self, path: str) -> int:
+        return os.open(path, os.O_RDWR)
+
+    def wait_for_socket(self, addr: str | tuple[str, int], timeout: float = 5) -> bool:
+        """
+        Wait until `addr` (unix socket path or (host, port)) accepts connections
+        """
+        family = socket.AF_UNIX if isinstance(addr, str) else socket.AF_INET
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while True:
+            with socket.socket(family, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(addr)
+                    return True
+                except OSError:
+                    pass
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    def wait_for_path(self, path: str, timeout: float = 5) -> bool:
+        """
+        Wait until `path` exists, without touching it. For sockets of single-client
+        daemons, which exit once their first connection is closed.
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while not os.path.exists(path):
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        return True
+
+    def char_device(self, netdev: str) -> tuple[int, int]:
+        """
+        (major, minor) of the char device backing a macvtap `netdev`
+        """
+        dev_files = glob.glob(f"/sys/devices/virtual/net/{netdev}/tap*/dev")
+        if not dev_files:
+            raise OSError(f"cannot find char device of {netdev}")
+        major, minor = pathlib.Path(dev_files[0]).read_text().strip().split(":")
+        return int(major), int(minor)
+
+
+class RecordingHost(Host):
+    """
+    Act on the real host and record the spawned commands, see `ReplayHost`
+    """
+
+    def __init__(self):
+        self.records: list[dict] = []
+
+    def run(self, args, **kwargs) -> subprocess.CompletedProcess:
+        check = kwargs.pop("check", False)
+        ret = super().run(args, **kwargs)
+        self.records.append(
+            {
+                "args": args,
+                "input": _text(kwargs.get("input")),
+                "returncode": ret.returncode,
+                "stdout": _text(ret.stdout),
+                "stderr": _text(ret.stderr),
+            }
+        )
+        if check:
+            ret.check_returncode()
+        return ret
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.records, f, indent=2)
+
+
+class ReplayHost(Host):
+    """
+    Answer commands from the records of a `RecordingHost` instead of spawning them,
+    repeated commands get the recorded replies in order (the last one sticks)
+    """
+
+    def __init__(self, records: list[dict] | str):
+        if isinstance(records, str):
+            with open(records) as f:
+                records = json.load(f)
+        self.replies: dict[str, list[dict]] = {}
+        for r in records:
+            self.replies.setdefault(_key(r["args"]), []).append(r)
+
+    def run(self, args, **kwargs) -> subprocess.CompletedProcess:
+        replies = self.replies.get(_key(args))
+        if not replies:
+            raise OSError(f"no recorded reply for {args}")
+        r = replies.pop(0) if len(replies) > 1 else replies[0]
+        ret = subprocess.CompletedProcess(
+            args, r["returncode"], r["stdout"].encode(), r["stderr"].encode()
+        )
+        if kwargs.get("check"):
+            ret.check_returncode()
+        return ret
+
+
+@functools.cache
+def _find_qemu_binaries(path_env: str) -> dict[str, str]:
+    # scan PATH without spawning a shell
+    bins: dict[str, str] = {}
+    for d in path_env.split(os.pathsep):
+        try:
+            names = sorted(os.listdir(d or "."))
+        except OSError:
+            continue
+        for name in names:
+            if not name.startswith(QEMU_SYSTEM_PREFIX):
+                continue
+            path = os.path.join(d, name)
+            arch = name[len(QEMU_SYSTEM_PREFIX) :]
+            if arch not in bins and os.access(path, os.X_OK):
+                bins[arch] = path
+    return bins
+
+
+def _text(data) -> str:
+    if data is None:
+        return ""
+    return data.decode(errors="replace") if isinstance(data, bytes) else str(data)
+
+
+def _key(args) -> str:
+    return args if isinstance(args, str) else json.dumps([str(a) for a in args])
+
+
+_host: Host = Host()
+_local = threading.local()
+
+
+def current() -> Host:
+    return _host
+
+
+def set_host(host: Host) -> Host:
+    """
+    Replace the host backend, return the previous one
+    """
+    global _host
+    prev, _host = _host, host
+    netinfo.invalidate()
+    return prev
+
+
+@contextlib.contextmanager
+def unrecorded():
+    """
+    Keep the host operations within out of launch plans, for read-only probes and
+    operations a plan redoes from the host state at execution
+    """
+    prev = is_unrecorded()
+    _local.unrecorded = True
+    try:
+        yield
+    finally:
+        _local.unrecorded = prev
+
+
+def is_unrecorded() -> bool:
+    return getattr(_local, "unrecorded", False)
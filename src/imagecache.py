@@ -0,0 +1,173 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import logging
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from . import meta, utils
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(meta.STORAGE_DIR, "images")
+INDEX_FILE = os.path.join(CACHE_DIR, "index.json")
+DOWNLOAD_WORKERS = 8
+MIN_PART_SIZE = 16 << 20  # smaller images are fetched by one request
+CHUNK_SIZE = 1 << 20
+TIMEOUT = 30  # seconds without data
+SCHEMES = ("http", "https")
+
+
+def is_url(s: str) -> bool:
+    return urllib.parse.urlsplit(s).scheme in SCHEMES
+
+
+def _split(url: str) -> tuple[str, str | None]:
+    """
+    The url without its '#sha256=<hex>' fragment, and the checksum
+    """
+    url, fragment = urllib.parse.urldefrag(url)
+    algo, _, digest = fragment.partition("=")
+    if algo == "sha256" and digest:
+        return url, digest.lower()
+    if fragment:
+        raise ValueError(f"unsupported checksum '{fragment}', use '#sha256=<hex>'")
+    return url, None
+
+
+def _object_file(digest: str) -> str:
+    return os.path.join(CACHE_DIR, "objects", digest)
+
+
+def lookup(url: str) -> str | None:
+    """
+    The cached file of `url`, without downloading it
+    """
+    url, digest = _split(url)
+    with utils.locked_json(INDEX_FILE) as index:
+        return _lookup(index, url, digest)
+
+
+def _lookup(index: dict, url: str, digest: str | None) -> str | None:
+    digest = digest or index.setdefault("urls", {}).get(url)
+    objects = index.setdefault("objects", {})
+    if not digest or digest not in objects:
+        return None
+    file = _object_file(digest)
+    if not os.path.exists(file):
+        del objects[digest]
+        return None
+    index["urls"][url] = digest  # same content under another url
+    objects[digest]["last_used"] = time.time()
+    return file
+
+
+def fetch(url: str, max_size: int | None = None) -> str:
+    """
+    A local file of `url`, downloaded once into the cache.
+
+    A '#sha256=<hex>' fragment verifies the download, and finds the image under
+    any url. Least recently used images are evicted to keep the cache under
+    `max_size` bytes.
+    """
+    url, digest = _split(url)
+    with utils.locked_json(INDEX_FILE) as index:
+        if file := _lookup(index, url, digest):
+            log.info(f"Using cached {url}: {file}")
+            return file
+    os.makedirs(os.path.join(CACHE_DIR, "objects"), exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=CACHE_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "r+b") as f:
+            size = _download(url, f)
+            f.seek(0)
+            actual = hashlib.file_digest(f, "sha256").hexdigest()
+        if digest and actual != digest:
+            raise EnvironmentError(f"sha256 of {url} is {actual}, not {digest}")
+        file = _object_file(actual)
+        os.replace(tmp_file, file)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_file)
+    with utils.locked_json(INDEX_FILE) as index:
+        index.setdefault("urls", {})[url] = actual
+        objects = index.setdefault("objects", {})
+        objects[actual] = {"size": size, "last_used": time.time()}
+        if max_size is not None:
+            _evict(index, max_size, keep=actual)
+    log.info(f"Cached {url}: {file}")
+    return file
+
+
+def _evict(index: dict, max_size: int, keep: str):
+    objects = index["objects"]
+    total = sum(o["size"] for o in objects.values())
+    for digest in sorted(objects, key=lambda d: objects[d]["last_used"]):
+        if total <= max_size:
+            break
+        if digest == keep:
+            continue
+        log.info(f"Evicting cached image {digest}")
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(_object_file(digest))
+        total -= objects.pop(digest)["size"]
+    index["urls"] = {u: d for u, d in index["urls"].items() if d in objects}
+
+
+def _probe(url: str) -> tuple[str, int | None, bool]:
+    """
+    The url after redirects, the size and whether ranges are served
+    """
+    req = urllib.request.Request(url, method="HEAD")
+    try:
+        with urllib.request.urlopen(req, timeout=TIMEOUT) as r:
+            size = r.headers.get("Content-Length")
+            ranges = r.headers.get("Accept-Ranges") == "bytes"
+            return r.geturl(), int(size) if size else None, ranges
+    except urllib.error.HTTPError:  # e.g. HEAD not allowed
+        return url, None, False
+
+
+def _download(url: str, f) -> int:
+    url, size, ranges = _probe(url)
+    if not (size and ranges and size >= 2 * MIN_PART_SIZE):
+        log.info(f"Downloading {url} ...")
+        return _get(url, f)
+    n = min(DOWNLOAD_WORKERS, size // MIN_PART_SIZE)
+    bounds = [size * i // n for i in range(n + 1)]
+    log.info(f"Downloading {url} ({size} bytes) in {n} parts ...")
+    os.ftruncate(f.fileno(), size)
+    with concurrent.futures.ThreadPoolExecutor(n) as pool:
+        parts = [
+            pool.submit(_get, url, f, start, end)
+            for start, end in itertools.pairwise(bounds)
+        ]
+        for p in parts:
+            p.result()
+    return size
+
+
+def _get(url: str, f, start: int = 0, end: int | None = None) -> int:
+    """
+    Write the bytes [start, end) of `url` at the same offsets of `f`
+    """
+    req = urllib.request.Request(url)
+    if end is not None:
+        req.add_header("Range", f"bytes={start}-{end - 1}")
+    offset = start
+    with urllib.request.urlopen(req, timeout=TIMEOUT) as r:
+        if end is not None and r.status != 206:
+            raise EnvironmentError(f"{url} ignored the range {start}-{end - 1}")
+        while chunk := r.read(CHUNK_SIZE):
+            view = memoryview(chunk)
+            while view:
+                n = os.pwrite(f.fileno(), view, offset)
+                offset, view = offset + n, view[n:]
+    if end is not None and offset != end:
+        raise EnvironmentError(f"{url} ended at {offset}, expected {end}")
+    return offset - start
@@ -0,0 +1,68 @@
+import json
+import logging
+import os
+
+import pydantic
+
+from . import meta, utils
+
+log = logging.getLogger(__name__)
+
+LEASE_FILE = os.path.join(meta.STORAGE_DIR, "leases.json")
+
+
+class Lease(pydantic.BaseModel):
+    mac: str
+    ip: str | None = None
+    # devices created for the iface, reused by a warm restart if they still exist
+    mode: str | None = None
+    dev_id: str | None = None
+    ipnet: str | None = None  # host ip/net, may be moved off the iface
+    queues: int = 1
+
+
+def _key(vm_id: str, iface: str, index: int):
+    return f"{vm_id}/{iface}/{index}"
+
+
+def _load() -> dict[str, dict]:
+    try:
+        with open(LEASE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        log.warning(f"invalid lease file {LEASE_FILE}, ignore it")
+        return {}
+
+
+def get(vm_id: str, iface: str, index: int) -> Lease | None:
+    d = _load().get(_key(vm_id, iface, index))
+    if not d:
+        return None
+    try:
+        return Lease.model_validate(d)
+    except pydantic.ValidationError:
+        return None
+
+
+def get_all(vm_id: str) -> dict[str, Lease]:
+    """
+    Leases of `vm_id` keyed by iface
+    """
+    leases = {}
+    for key, d in _load().items():
+        parts = key.split("/")
+        if len(parts) != 3 or parts[0] != vm_id:
+            continue
+        try:
+            leases[parts[1]] = Lease.model_validate(d)
+        except pydantic.ValidationError:
+            continue
+    return leases
+
+
+def put(vm_id: str, iface: str, index: int, lease: Lease):
+    # concurrent launches on a shared storage update their own keys
+    with utils.locked_json(LEASE_FILE) as leases:
+        leases[_key(vm_id, iface, index)] = lease.model_dump()
@@ -1,14 +1,20 @@
 import abc
+import contextlib
+import contextvars
+import copy
 import enum
+import functools
 import ipaddress
 import os
 import pathlib
+import shlex
 
-import dynaconf
 import pydantic
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 STORAGE_DIR = "/storage" if os.path.exists("/storage") else ".storage"
+SETTINGS_FILE = "settings.yaml"
+DOTENV_FILE = ".env"
 
 
 #
@@ -21,60 +27,189 @@ TQemuKDictOpt = dict[str, dict[str, TQemuVal]]
 TQemuConfig = list[dict[str, None | TQemuVal | TQemuKValOpt | TQemuKDictOpt]]
 
 
+def _is_qemu_val(value) -> bool:
+    return isinstance(value, str | int | float)
+
+
+def _fmt_qemu_val(value: TQemuVal) -> str:
+    if isinstance(value, bool):
+        return "on" if value else "off"
+    return str(value)
+
+
 class QemuOpt(abc.ABC):
-    type_adapter: pydantic.TypeAdapter
+    """
+    A classified Qemu option, rendered to argv once when it's created
+    """
+
+    def __init__(self, key: str, value):
+        self.key = key
+        self.value = copy.deepcopy(value)
+        self.argv = tuple(self.render())
 
     @abc.abstractmethod
-    def to_opts(self) -> list[str]:
+    def render(self) -> list[str]:
         pass
 
-    @classmethod
-    def validate(cls, inst) -> bool:
-        try:
-            cls.type_adapter.validate_python(inst)
-            return True
-        except pydantic.ValidationError:
-            return False
+    @staticmethod
+    def classify(key: str, value) -> "QemuOpt":
+        if value is None or isinstance(value, bool):
+            return QemuOptFlag(key, value)
+        if isinstance(value, dict):
+            if all(_is_qemu_val(v) for v in value.values()):
+                return QemuOptKVal(key, value)
+            if all(
+                isinstance(d, dict) and all(_is_qemu_val(v) for v in d.values())
+                for d in value.values()
+            ):
+                return QemuOptKDict(key, value)
+        elif _is_qemu_val(value):
+            return QemuOptVal(key, value)
+        raise TypeError(f"invalid qemu option '{key}': {value!r}")
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.key!r}, {self.value!r})"
+
 
+class QemuOptFlag(QemuOpt):
+    def render(self) -> list[str]:
+        # None/True enables the flag, False drops it
+        return [] if self.value is False else [f"-{self.key}"]
 
-class QemuOptKVal(QemuOpt, TQemuKValOpt):
-    type_adapter = pydantic.TypeAdapter(TQemuKValOpt)
 
-    def to_opts(self) -> list[str]:
-        return [", ".join(f"{key}={val}" for key, val in self.items())]
+class QemuOptVal(QemuOpt):
+    def render(self) -> list[str]:
+        return [f"-{self.key}", _fmt_qemu_val(self.value)]
 
 
-class QemuOptKDict(QemuOpt, TQemuKDictOpt):
+class QemuOptKVal(QemuOpt):
+    def render(self) -> list[str]:
+        opts = ",".join(f"{k}={_fmt_qemu_val(v)}" for k, v in self.value.items())
+        return [f"-{self.key}", opts]
+
+
+class QemuOptKDict(QemuOpt):
     RAW_KEY = "__raw__"
-    type_adapter = pydantic.TypeAdapter(TQemuKDictOpt)
 
-    def to_opts(self) -> list[str]:
+    def render(self) -> list[str]:
         args = []
-        for key, d in self.items():
-            ext_args = d.pop(self.RAW_KEY, "")
-            opts = ",".join(f"{k}={v}" for k, v in d.items())
-            if ext_args:
-                opts += f",{ext_args}"
-            args.append(f"{key},{opts}")
+        for name, d in self.value.items():
+            opts = [name]
+            opts.extend(
+                f"{k}={_fmt_qemu_val(v)}" for k, v in d.items() if k != self.RAW_KEY
+            )
+            if ext_args := d.get(self.RAW_KEY):
+                opts.append(str(ext_args))
+            args.extend([f"-{self.key}", ",".join(opts)])
         return args
 
 
-class QemuConfig(TQemuConfig):
-    ext_args: list[str] = []
+_deferred_qemu_ops: contextvars.ContextVar[list | None] = contextvars.ContextVar(
+    "deferred_qemu_ops", default=None
+)
+
+
+@contextlib.contextmanager
+def deferred_qemu_ops():
+    """
+    Record `QemuConfig` appends/inserts in the current context instead of applying
+    them, so concurrent stages can be replayed in a deterministic order
+    """
+    ops: list[tuple[QemuConfig, int | None, list[QemuOpt]]] = []
+    token = _deferred_qemu_ops.set(ops)
+    try:
+        yield ops
+    finally:
+        _deferred_qemu_ops.reset(token)
+
+
+def replay_qemu_ops(ops: list[tuple["QemuConfig", int | None, list["QemuOpt"]]]):
+    for qemu, index, opts in ops:
+        if index is None:
+            qemu.extend(opts)
+        else:
+            qemu[index:index] = opts
+
+
+class QemuConfig(list):
+    """
+    Qemu options, dicts are classified into `QemuOpt` when they are added and
+    the argv is cached until the options change
+    """
+
+    def __init__(self, opts: TQemuConfig = ()):
+        super().__init__()
+        self.pass_fds: list[int] = []  # fds inherited by Qemu, e.g. macvtap
+        self._argv: tuple[str, ...] | None = None
+        self.extend(opts)
+
+    @staticmethod
+    def _compile(opt) -> list[QemuOpt]:
+        if isinstance(opt, QemuOpt):
+            return [opt]
+        return [QemuOpt.classify(k, v) for k, v in opt.items()]
+
+    def _changed(self):
+        self._argv = None
+
+    def _defer(self, index: int | None, opts: list[QemuOpt]) -> bool:
+        if (ops := _deferred_qemu_ops.get()) is None:
+            return False
+        ops.append((self, index, opts))
+        return True
+
+    def append(self, opt):
+        self.extend([opt])
+
+    def insert(self, index, opt):
+        opts = self._compile(opt)
+        if not self._defer(index, opts):
+            self[index:index] = opts
+
+    def extend(self, opts):
+        opts = [o for opt in opts for o in self._compile(opt)]
+        if not self._defer(None, opts):
+            super().extend(opts)
+            self._changed()
+
+    def __iadd__(self, opts):
+        self.extend(opts)
+        return self
+
+    def __setitem__(self, index, opt):
+        if isinstance(index, slice):
+            opt = [o for i in opt for o in self._compile(i)]
+        else:
+            (opt,) = self._compile(opt)
+        super().__setitem__(index, opt)
+        self._changed()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._changed()
+
+    def pop(self, index=-1):
+        self._changed()
+        return super().pop(index)
+
+    def remove(self, opt):
+        super().remove(opt)
+        self._changed()
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def _compiled_argv(self) -> tuple[str, ...]:
+        if self._argv is None:
+            self._argv = tuple(a for opt in self for a in opt.argv)
+        return self._argv
+
+    def to_argv(self) -> list[str]:
+        return list(self._compiled_argv())
 
     def to_args(self) -> str:
-        args = []
-        for opt in self:
-            for key, value in opt.items():
-                if value is None or (isinstance(value, bool) and value):
-                    args.append(f"-{key}")
-                elif QemuOptKVal.validate(value):
-                    args.extend(f"-{key} {v}" for v in QemuOptKVal(value).to_opts())  # noqa
-                elif QemuOptKDict.validate(value):
-                    args.extend(f"-{key} {v}" for v in QemuOptKDict(value).to_opts())  # noqa
-                else:
-                    args.append(f"-{key} {value}")
-        return " ".join(args + self.ext_args)
+        return shlex.join(self._compiled_argv())
 
 
 #
@@ -82,13 +217,18 @@ class QemuConfig(TQemuConfig):
 #
 
 
-settings = dynaconf.Dynaconf(
-    envvar_prefix="",
-    settings_files=["settings.yaml"],
-    merge_enabled=True,
-    environments=False,
-    load_dotenv=True,
-)
+@functools.cache
+def get_settings():
+    import dynaconf  # slow to import, only needed when the config is loaded
+
+    return dynaconf.Dynaconf(
+        envvar_prefix="",
+        settings_files=[SETTINGS_FILE],
+        merge_enabled=True,
+        environments=False,
+        load_dotenv=True,
+    )
+
 
 #
 # ContainerVm Config
@@ -100,6 +240,40 @@ class WinOpts(pydantic.BaseModel):
     enable_tmp: bool = True
 
 
+class FsCache(enum.StrEnum):
+    AUTO = "auto"  # revalidated on open, like NFS close-to-open
+    ALWAYS = "always"  # the host directory isn't changed by others
+    NEVER = "never"  # the host directory is changed under the guest
+    METADATA = "metadata"
+
+
+class Share(pydantic.BaseModel):
+    """
+    A host directory shared by virtiofs, see `virtiofs.start`
+    """
+
+    path: str
+    tag: str
+    cache: FsCache = FsCache.AUTO
+    thread_pool_size: int | None = None
+    dax_window: str | None = None  # e.g. 4G, needs a Qemu with virtio-fs DAX
+    readonly: bool = False
+
+
+class IoProfile(enum.StrEnum):
+    DEFAULT = "default"  # plain '-drive' with the Qemu defaults
+    THROUGHPUT = "throughput"
+    LATENCY = "latency"
+    SAFE = "safe"  # every write is durable when it completes
+
+
+class Preallocation(enum.StrEnum):
+    OFF = "off"
+    METADATA = "metadata"  # qcow2 only
+    FALLOC = "falloc"
+    FULL = "full"
+
+
 class BootMode(enum.StrEnum):
     UEFI = "uefi"
     SECURE = "secure"
@@ -116,8 +290,11 @@ class Config(pydantic.BaseModel):
     cpu_num: int | None = None
     mem_size: int | None = None
     iso: str | None = None
+    image_cache_size: int = 32768  # MB, images downloaded from urls, LRU evicted
     enable_accel: bool = True
     enable_macvlan: bool = True
+    enable_passt: bool = False
+    net_queues: int | None = None  # virtio-net queues, see `vm.get_net_queues`
     enable_dhcp: bool = True
     enable_vnc_web: bool = True
     enable_console: bool = True
@@ -131,13 +308,28 @@ class Config(pydantic.BaseModel):
     extra_args: str = ""
     win_opts: WinOpts | None = None
     port_forwards: list[str] | None = None
+    port_proxy: bool | None = None  # None: only if iptables NAT is unavailable
     dry_run: bool = False
+    exec_qemu: bool = True
+    profile: bool = False
+    plan_file: pathlib.Path | None = None
+    save_state: bool = False
+    compact_interval: float | None = None  # hours, see `compact.Compactor`
+    shares: list[Share] = []
     exec_files: list[pathlib.Path] = []
 
-    def __init__(self, *args, **kwargs):
-        if (qemu_opts := kwargs.get("qemu")) and not isinstance(qemu_opts, QemuConfig):
-            kwargs["qemu"] = QemuConfig(qemu_opts)
-        super().__init__(*args, **kwargs)
+    @pydantic.field_validator("qemu", mode="before")
+    @classmethod
+    def _compile_qemu(cls, v):
+        if v is None:
+            return QemuConfig()
+        if not isinstance(v, QemuConfig):
+            return QemuConfig(v)
+        return v
+
+    @property
+    def qemu_argv(self) -> list[str]:
+        return self.qemu.to_argv() + shlex.split(self.extra_args)
 
     @property
     def qemu_args(self):
@@ -153,11 +345,20 @@ class Config(pydantic.BaseModel):
     def is_win(self):
         return self.win_opts is not None
 
+    @property
+    def network_mode(self) -> "NetworkMode":
+        if self.enable_passt:
+            return NetworkMode.PASST
+        if self.enable_macvlan:
+            return NetworkMode.MACVLAN
+        return NetworkMode.TAP_BRIDGE
+
 
-config: Config
+config: Config  # loaded on first access, see `__getattr__`
 
 
 def load_config(path: str | None = None):
+    settings = get_settings()
     if path:
         settings.load_file(path=path)
 
@@ -167,9 +368,13 @@ def load_config(path: str | None = None):
         if k.isupper():  # copy upper case to lower case
             d[k.lower()] = d[k]
     config = Config.model_validate(d)
+    return config
 
 
-load_config()
+def __getattr__(name: str):
+    if name == "config":
+        return load_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 #
@@ -180,9 +385,13 @@ load_config()
 class NetworkMode(enum.StrEnum):
     TAP_BRIDGE = "tapbr"
     MACVLAN = "macvlan"
+    PASST = "passt"  # user-mode, no 'NET_ADMIN' needed
 
 
 class VmPort(enum.IntEnum):
     TELNET = 10000
     QMP = 10001
     VNC_WS = 5800
+
+
+GUEST_AGENT_SOCKET = "/run/qemu-ga.sock"  # chardev of the guest agent channel
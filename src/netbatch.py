@@ -0,0 +1,93 @@
+import contextlib
+import logging
+import subprocess
+import typing
+
+from . import netinfo, utils
+
+log = logging.getLogger(__name__)
+
+TUndo = str | typing.Callable[[], typing.Any]
+
+
+def _run_ip_batch(cmds: list[str], force=False):
+    args = ["ip", "-force", "-batch", "-"] if force else ["ip", "-batch", "-"]
+    try:
+        utils.sh(args, input="\n".join(cmds).encode(), check=not force)
+    except subprocess.CalledProcessError as e:
+        raise OSError(f"ip batch failed: {e.stderr.decode().strip()}") from e
+
+
+class IpBatch:
+    """
+    Queue `ip` commands and apply them with a single `ip -batch` process,
+    undo commands are replayed in reverse order on rollback
+    """
+
+    def __init__(self):
+        self.pending: list[str] = []
+        self.undo: list[TUndo] = []
+
+    def add(self, cmd: str, undo: TUndo | None = None):
+        self.pending.append(cmd)
+        if undo is not None:
+            self.undo.append(undo)
+
+    def on_rollback(self, undo: TUndo):
+        self.undo.append(undo)
+
+    def flush(self):
+        if not self.pending:
+            return
+        cmds, self.pending = self.pending, []
+        log.debug(f"ip batch: {cmds}")
+        try:
+            _run_ip_batch(cmds)
+        finally:
+            netinfo.invalidate()
+
+    def commit(self):
+        self.flush()
+        self.undo = []
+
+    def rollback(self):
+        try:
+            self._rollback()
+        finally:
+            netinfo.invalidate()
+
+    def _rollback(self):
+        self.pending = []
+        undo, self.undo = self.undo, []
+        cmds: list[str] = []
+        for u in reversed(undo):
+            if isinstance(u, str):
+                cmds.append(u)
+                continue
+            if cmds:
+                _run_ip_batch(cmds, force=True)
+                cmds = []
+            try:
+                u()
+            except (subprocess.CalledProcessError, OSError) as e:
+                log.warning(f"rollback step failed: {e}")
+        if cmds:
+            _run_ip_batch(cmds, force=True)
+
+
+@contextlib.contextmanager
+def transaction(batch: IpBatch | None = None):
+    """
+    Join `batch` if given, otherwise commit a new batch and roll it back on error
+    """
+    if batch is not None:
+        yield batch
+        return
+    batch = IpBatch()
+    try:
+        yield batch
+        batch.commit()
+    except BaseException:
+        log.warning("network setup failed, rolling back ...")
+        batch.rollback()
+        raise
@@ -0,0 +1,178 @@
+import logging
+import os
+import socket
+import struct
+
+import pydantic
+
+log = logging.getLogger(__name__)
+
+SYS_CLASS_NET = "/sys/class/net"
+PROC_NET_ROUTE = "/proc/net/route"
+RESOLV_CONF = "/etc/resolv.conf"
+
+IFF_LOOPBACK = 0x8
+
+# rtnetlink
+NETLINK_TIMEOUT = 5
+NLMSG_HDR = struct.Struct("=LHHLL")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTATTR = struct.Struct("=HH")
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_BROADCAST = 4
+
+
+class Interface(pydantic.BaseModel):
+    name: str
+    index: int
+    mac: str | None = None
+    flags: int = 0
+    ipnets: list[str] = []  # ip/cidr with broadcast
+
+    @property
+    def is_loopback(self):
+        return bool(self.flags & IFF_LOOPBACK)
+
+
+class Inventory(pydantic.BaseModel):
+    interfaces: dict[str, Interface] = {}
+    default_gateway: str = ""
+    default_interface: str = ""
+    nameservers: list[str] = []
+
+
+def _read(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _align(n: int) -> int:
+    return (n + 3) & ~3
+
+
+def _parse_rtattrs(data: bytes) -> dict[int, bytes]:
+    attrs, off = {}, 0
+    while off + RTATTR.size <= len(data):
+        length, typ = RTATTR.unpack_from(data, off)
+        if length < RTATTR.size:
+            break
+        attrs[typ] = data[off + RTATTR.size : off + length]
+        off += _align(length)
+    return attrs
+
+
+def dump_ipv4_addrs() -> dict[int, list[str]]:
+    """
+    Dump IPv4 'ip/cidr' (with broadcast) of all interfaces, keyed by ifindex
+    """
+    addrs: dict[int, list[str]] = {}
+    with socket.socket(
+        socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE
+    ) as sock:
+        sock.settimeout(NETLINK_TIMEOUT)
+        sock.bind((0, 0))
+        body = IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0)
+        flags = NLM_F_REQUEST | NLM_F_DUMP
+        hdr = NLMSG_HDR.pack(NLMSG_HDR.size + len(body), RTM_GETADDR, flags, 1, 0)
+        sock.send(hdr + body)
+        while True:
+            data = sock.recv(1 << 16)
+            off = 0
+            while off + NLMSG_HDR.size <= len(data):
+                length, typ, _, _, _ = NLMSG_HDR.unpack_from(data, off)
+                if typ == NLMSG_DONE:
+                    return addrs
+                if typ == NLMSG_ERROR:
+                    (err,) = struct.unpack_from("=i", data, off + NLMSG_HDR.size)
+                    raise OSError(-err, os.strerror(-err))
+                if typ == RTM_NEWADDR:
+                    msg = off + NLMSG_HDR.size
+                    family, prefixlen, _, _, index = IFADDRMSG.unpack_from(data, msg)
+                    attrs = _parse_rtattrs(data[msg + IFADDRMSG.size : off + length])
+                    ip = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+                    if family == socket.AF_INET and ip and IFA_BROADCAST in attrs:
+                        ipnet = f"{socket.inet_ntoa(ip)}/{prefixlen}"
+                        addrs.setdefault(index, []).append(ipnet)
+                off += _align(length)
+
+
+def read_default_route() -> tuple[str, str]:
+    """
+    Return (gateway, iface) of the first default route in /proc/net/route
+    """
+    try:
+        with open(PROC_NET_ROUTE) as f:
+            lines = f.read().splitlines()[1:]
+    except OSError:
+        return "", ""
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 8 or fields[1] != "00000000" or fields[7] != "00000000":
+            continue
+        gw = socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
+        return gw, fields[0]
+    return "", ""
+
+
+def read_nameservers() -> list[str]:
+    content = _read(RESOLV_CONF) or ""
+    return [
+        line.split()[1]
+        for line in content.splitlines()
+        if line.startswith("nameserver") and len(line.split()) > 1
+    ]
+
+
+def scan() -> Inventory:
+    addrs = dump_ipv4_addrs()
+    interfaces = {}
+    for name in sorted(os.listdir(SYS_CLASS_NET)):
+        d = os.path.join(SYS_CLASS_NET, name)
+        index = _read(os.path.join(d, "ifindex"))
+        if index is None:  # removed while scanning
+            continue
+        flags = _read(os.path.join(d, "flags")) or "0"
+        interfaces[name] = Interface(
+            name=name,
+            index=int(index),
+            mac=_read(os.path.join(d, "address")) or None,
+            flags=int(flags, 16),
+            ipnets=addrs.get(int(index), []),
+        )
+    gw, iface = read_default_route()
+    return Inventory(
+        interfaces=interfaces,
+        default_gateway=gw,
+        default_interface=iface,
+        nameservers=read_nameservers(),
+    )
+
+
+_inventory: Inventory | None = None
+
+
+def get() -> Inventory:
+    """
+    Cached network inventory, call `invalidate` after mutating links/addresses
+    """
+    from . import host  # the host backend builds on this module
+
+    global _inventory
+    if _inventory is None:
+        _inventory = host.current().inventory()
+    return _inventory
+
+
+def invalidate():
+    global _inventory
+    _inventory = None
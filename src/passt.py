@@ -0,0 +1,58 @@
+import logging
+import subprocess
+
+from . import host, utils
+from .portfwd import PortForward
+
+log = logging.getLogger(__name__)
+
+RUN_DIR = "/run"
+START_TIMEOUT = 5  # seconds
+
+
+def is_available() -> bool:
+    try:
+        with host.unrecorded():
+            return utils.sh(["passt", "--version"], check=False).returncode == 0
+    except OSError:
+        return False
+
+
+def _ports(ports: tuple[int, int]) -> str:
+    return str(ports[0]) if ports[0] == ports[1] else f"{ports[0]}-{ports[1]}"
+
+
+def forward_args(fwds: list[PortForward]) -> list[str]:
+    """
+    passt '-t'/'-u' options, the port specs map onto them as they are
+    """
+    args = []
+    for f in dict.fromkeys(fwds):
+        spec = _ports(f.host_ports)
+        if not f.is_identity:
+            spec += ":" + _ports(f.vm_ports)
+        args += ["-t" if f.protocol == "tcp" else "-u", spec]
+    return args
+
+
+def start(iface: str, nic_id: str, fwds: list[PortForward]) -> str:
+    """
+    Start a passt daemon for `iface`, return the socket for Qemu '-netdev stream'.
+
+    The guest gets the address, routes and DNS of `iface` by passt's own DHCP.
+    """
+    sock_file = f"{RUN_DIR}/passt-{nic_id}.sock"
+    pid_file = f"{RUN_DIR}/passt-{nic_id}.pid"
+    # the daemon of the last start holds the socket and the forwarded ports
+    utils.sh(["pkill", "-F", pid_file], check=False)
+    utils.sh(["rm", "-f", sock_file, pid_file])
+    args = ["passt", "--quiet", "--interface", iface]
+    args += ["--socket", sock_file, "--pid", pid_file, *forward_args(fwds)]
+    log.info(f"Running {' '.join(args)} ...")
+    try:
+        utils.sh(args)
+    except subprocess.CalledProcessError as e:
+        raise EnvironmentError(f"failed to start passt: {e.stderr.decode()}") from e
+    if not host.current().wait_for_socket(sock_file, timeout=START_TIMEOUT):
+        raise EnvironmentError("failed to start passt")
+    return sock_file
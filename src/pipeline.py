@@ -0,0 +1,68 @@
+import concurrent.futures
+import contextvars
+import logging
+import typing
+
+from . import meta, trace
+
+log = logging.getLogger(__name__)
+
+MAX_WORKERS = 8
+
+
+class Stage(typing.NamedTuple):
+    name: str
+    func: typing.Callable[..., typing.Any]  # called with the results of `deps`
+    deps: tuple[str, ...] = ()
+
+
+def _run_stage(stage: Stage, args: list) -> tuple[typing.Any, list]:
+    with trace.phase(stage.name), meta.deferred_qemu_ops() as ops:
+        return stage.func(*args), ops
+
+
+def run(stages: list[Stage], max_workers: int = MAX_WORKERS) -> dict[str, typing.Any]:
+    """
+    Run `stages` concurrently as soon as their deps are done, return their results.
+
+    Qemu options added by the stages are applied in the order of `stages`, so the
+    rendered argv does not depend on scheduling.
+    """
+    names = {s.name for s in stages}
+    for s in stages:
+        if missing := set(s.deps) - names:
+            raise ValueError(f"stage '{s.name}' depends on unknown stages {missing}")
+
+    results: dict[str, typing.Any] = {}
+    qemu_ops: dict[str, list] = {}
+    pending = list(stages)
+    running: dict[concurrent.futures.Future, Stage] = {}
+    error: BaseException | None = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        while True:
+            if error is None:
+                for s in [s for s in pending if all(d in results for d in s.deps)]:
+                    pending.remove(s)
+                    args = [results[d] for d in s.deps]
+                    ctx = contextvars.copy_context()
+                    running[pool.submit(ctx.run, _run_stage, s, args)] = s
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for f in done:
+                s = running.pop(f)
+                # running stages are waited for, the first error is raised then
+                if (e := f.exception()) is not None:
+                    log.error(f"stage '{s.name}' failed: {e}")
+                    error = error or e
+                else:
+                    results[s.name], qemu_ops[s.name] = f.result()
+    if error is not None:
+        raise error
+    if pending:
+        raise ValueError(f"dependency cycle in stages {[s.name for s in pending]}")
+    for s in stages:
+        meta.replay_qemu_ops(qemu_ops[s.name])
+    return results
@@ -0,0 +1,278 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shlex
+import subprocess
+import sys
+
+from . import host, imagecache, meta, portfwd, service, vm
+
+log = logging.getLogger(__name__)
+
+PLAN_VERSION = 3
+
+
+def input_digest(config_keys: list[str]) -> str:
+    """
+    Hash everything a launch is resolved from: command line, settings files,
+    config environment variables and the host network
+    """
+    keys = {k.lower() for k in config_keys}
+    files = {}
+    for name in (meta.SETTINGS_FILE, meta.DOTENV_FILE):
+        with contextlib.suppress(OSError):
+            files[name] = hashlib.sha256(pathlib.Path(name).read_bytes()).hexdigest()
+    inv = host.current().inventory()
+    inputs = {
+        "version": PLAN_VERSION,
+        "argv": sys.argv[1:],
+        "env": {k: v for k, v in os.environ.items() if k.lower() in keys},
+        "files": files,
+        # not MACs and ifindexes, they change with every new container
+        "interfaces": {name: i.ipnets for name, i in inv.interfaces.items()},
+        "route": [inv.default_gateway, inv.default_interface],
+        "nameservers": inv.nameservers,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class Recorder(host.Host):
+    """
+    Delegate to `inner` and record the operations which change the host, in the
+    order they are done
+    """
+
+    def __init__(self, inner: host.Host, digest: str):
+        self.inner = inner
+        self.digest = digest
+        self.ops: list[dict] = []
+        self._char_devices: dict[tuple[int, int], str] = {}
+
+    def save(
+        self,
+        path: pathlib.Path,
+        argv: list[str],
+        pass_fds: list[int],
+        services: list[service.LoopService],
+    ):
+        plan = {
+            "version": PLAN_VERSION,
+            "digest": self.digest,
+            "config_keys": list(meta.Config.model_fields),
+            "ops": self.ops,
+            "argv": argv,
+            "pass_fds": list(pass_fds),
+            "services": [s.spec() for s in services],
+        }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(plan, f, indent=2)
+        os.replace(tmp_file, path)
+        log.info(f"launch plan is written to {path}")
+
+    def run(self, args, **kwargs) -> subprocess.CompletedProcess:
+        ret = self.inner.run(args, **kwargs)
+        if host.is_unrecorded():
+            return ret
+        inp = kwargs.get("input")
+        self.ops.append(
+            {
+                "op": "run",
+                "args": args,
+                "input": inp.decode() if isinstance(inp, bytes) else inp,
+                "check": bool(kwargs.get("check")),
+                "capture": kwargs.get("stdout") is not None,
+            }
+        )
+        return ret
+
+    def inventory(self):
+        return self.inner.inventory()
+
+    def probe(self, ips, iface=None):
+        return self.inner.probe(ips, iface)
+
+    def qemu_binaries(self):
+        return self.inner.qemu_binaries()
+
+    def exists(self, path: str) -> bool:
+        return self.inner.exists(path)
+
+    def write_file(self, path: str, content: str):
+        self.inner.write_file(path, content)
+        if host.is_unrecorded():
+            return
+        self.ops.append({"op": "write_file", "path": path, "content": content})
+
+    def mknod(self, path: str, mode: int, major: int, minor: int):
+        self.inner.mknod(path, mode, major, minor)
+        if host.is_unrecorded():
+            return
+        self.ops.append(
+            {
+                "op": "mknod",
+                "path": path,
+                "mode": mode,
+                "major": major,
+                "minor": minor,
+                # a macvtap gets its numbers on creation, resolved on execution
+                "netdev": self._char_devices.get((major, minor)),
+            }
+        )
+
+    def remove(self, path: str):
+        self.inner.remove(path)
+        if host.is_unrecorded():
+            return
+        self.ops.append({"op": "remove", "path": path})
+
+    def open_device(self, path: str) -> int:
+        fd = self.inner.open_device(path)
+        if host.is_unrecorded():
+            return fd
+        self.ops.append({"op": "open_device", "path": path, "fd": fd})
+        return fd
+
+    def wait_for_socket(self, addr, timeout: float = 5) -> bool:
+        ok = self.inner.wait_for_socket(addr, timeout)
+        self.ops.append({"op": "wait_for_socket", "addr": addr, "timeout": timeout})
+        return ok
+
+    def wait_for_path(self, path: str, timeout: float = 5) -> bool:
+        ok = self.inner.wait_for_path(path, timeout)
+        self.ops.append({"op": "wait_for_path", "path": path, "timeout": timeout})
+        return ok
+
+    def char_device(self, netdev: str) -> tuple[int, int]:
+        dev = self.inner.char_device(netdev)
+        self._char_devices[dev] = netdev
+        return dev
+
+
+def apply_port_forwards(fwds: list[portfwd.PortForward], ip: str):
+    """
+    `portfwd.apply`, recorded as one op: the rules depend on the nat table, which
+    is read again when the plan is executed
+    """
+    h = host.current()
+    with host.unrecorded():
+        portfwd.apply(fwds, ip)
+    if isinstance(h, Recorder):
+        h.ops.append({"op": "port_forward", "fwds": fwds, "ip": ip})
+
+
+@contextlib.contextmanager
+def recording():
+    """
+    Record the host operations of a launch, the inputs are hashed up front
+    """
+    digest = input_digest(list(meta.Config.model_fields))
+    recorder = Recorder(host.current(), digest)
+    prev = host.set_host(recorder)
+    try:
+        yield recorder
+    finally:
+        host.set_host(prev)
+
+
+def load(path: pathlib.Path) -> dict | None:
+    """
+    The plan in `path` if it's still valid for the current inputs
+    """
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        log.warning(f"invalid launch plan {path}, ignore it")
+        return None
+    if plan.get("version") != PLAN_VERSION:
+        return None
+    if plan.get("digest") != input_digest(plan.get("config_keys", [])):
+        log.info(f"inputs of launch plan {path} changed, rebuilding it")
+        return None
+    for fd in plan["pass_fds"]:
+        with contextlib.suppress(OSError):
+            os.fstat(fd)
+            log.info(f"fd {fd} of launch plan {path} is taken, rebuilding it")
+            return None
+    for arg in plan["argv"]:
+        for file in (p.removeprefix("file=") for p in arg.split(",")):
+            if file.startswith(imagecache.CACHE_DIR) and not os.path.exists(file):
+                log.info(f"{file} of launch plan {path} was evicted, rebuilding it")
+                return None
+    return plan
+
+
+def execute(plan: dict, replace=True, dry=False):
+    """
+    Redo the recorded host operations, start the recorded services and launch
+    Qemu with the recorded argv
+    """
+    h = host.current()
+    for op in plan["ops"]:
+        match op["op"]:
+            case "run":
+                out = subprocess.PIPE if op["capture"] else None
+                h.run(
+                    op["args"],
+                    input=op["input"].encode() if op["input"] is not None else None,
+                    stdout=out,
+                    stderr=out,
+                    check=op["check"],
+                )
+            case "write_file":
+                h.write_file(op["path"], op["content"])
+            case "mknod":
+                major, minor = op["major"], op["minor"]
+                if h.exists(op["path"]):  # made by an earlier execution
+                    if not op["netdev"]:
+                        continue
+                    h.remove(op["path"])  # a new macvtap may get new numbers
+                if op["netdev"]:
+                    major, minor = h.char_device(op["netdev"])
+                h.mknod(op["path"], op["mode"], major, minor)
+            case "remove":
+                with contextlib.suppress(FileNotFoundError):
+                    h.remove(op["path"])
+            case "port_forward":
+                fwds = [
+                    portfwd.PortForward(p, tuple(hp), tuple(vp))
+                    for p, hp, vp in op["fwds"]
+                ]
+                portfwd.apply(fwds, op["ip"])
+            case "open_device":
+                fd = h.open_device(op["path"])
+                os.set_inheritable(fd, True)
+                if fd != op["fd"]:  # the argv refers to the recorded fd
+                    os.dup2(fd, op["fd"])
+                    os.close(fd)
+            case "wait_for_socket":
+                addr = op["addr"]
+                addr = addr if isinstance(addr, str) else tuple(addr)
+                if not h.wait_for_socket(addr, op["timeout"]):
+                    raise EnvironmentError(f"'{addr}' is not ready")
+            case "wait_for_path":
+                if not h.wait_for_path(op["path"], op["timeout"]):
+                    raise EnvironmentError(f"'{op['path']}' is not ready")
+            case _:
+                raise ValueError(f"unknown launch plan op '{op['op']}'")
+    argv = plan["argv"]
+    services = [service.from_spec(s) for s in plan["services"]]
+    log.info(f"Running {shlex.join(argv)} ...")
+    if dry:
+        return
+    if replace:
+        if services:
+            service.detach(services, plan["pass_fds"])
+        vm.exec_qemu(argv, plan["pass_fds"])
+        return
+    with contextlib.ExitStack() as stack:
+        for s in services:
+            stack.enter_context(s)
+        vm.exec_qemu(argv, plan["pass_fds"], replace=False)
@@ -0,0 +1,118 @@
+import logging
+import re
+import typing
+
+from . import utils
+
+log = logging.getLogger(__name__)
+
+# our own chains, flushed and refilled on every start instead of appending rules
+CHAINS = {"PREROUTING": "CVM-PREROUTING", "POSTROUTING": "CVM-POSTROUTING"}
+MULTIPORT_MAX = 15  # ports per multiport match, a range takes two
+SPEC_REGEX = re.compile(r"(\d+)(?:-(\d+))?(?::(\d+)(?:-(\d+))?)?(?:/(tcp|udp))?")
+
+
+class PortForward(typing.NamedTuple):
+    protocol: str
+    host_ports: tuple[int, int]  # first and last port
+    vm_ports: tuple[int, int]
+
+    @property
+    def is_range(self):
+        return self.host_ports[0] != self.host_ports[1]
+
+    @property
+    def is_identity(self):
+        return self.host_ports == self.vm_ports
+
+
+def _ports(first: str, last: str | None) -> tuple[int, int]:
+    ports = (int(first), int(last or first))
+    if not 0 < ports[0] <= ports[1] <= 65535:
+        raise ValueError(f"invalid port range {first}-{last}")
+    return ports
+
+
+def parse(spec: str) -> PortForward:
+    """
+    Parse 'host_port[-last][:vm_port[-last]][/tcp|udp]', e.g. '80:8080',
+    '53/udp' or '5900-5910/tcp'
+    """
+    m = SPEC_REGEX.fullmatch(spec.strip())
+    if not m:
+        raise ValueError(f"invalid port forward spec: {spec}")
+    host_first, host_last, vm_first, vm_last, protocol = m.groups()
+    host_ports = _ports(host_first, host_last)
+    vm_ports = _ports(vm_first, vm_last) if vm_first else host_ports
+    fwd = PortForward(protocol or "tcp", host_ports, vm_ports)
+    if fwd.is_range and not fwd.is_identity:
+        raise ValueError(f"port ranges must be forwarded to the same ports: {spec}")
+    return fwd
+
+
+def _fmt(ports: tuple[int, int]) -> str:
+    return str(ports[0]) if ports[0] == ports[1] else f"{ports[0]}:{ports[1]}"
+
+
+def _chunks(fwds: list[PortForward]) -> typing.Iterator[list[PortForward]]:
+    chunk: list[PortForward] = []
+    slots = 0
+    for f in fwds:
+        n = 2 if f.is_range else 1
+        if slots + n > MULTIPORT_MAX:
+            yield chunk
+            chunk, slots = [], 0
+        chunk.append(f)
+        slots += n
+    if chunk:
+        yield chunk
+
+
+def build_rules(fwds: list[PortForward], ip: str) -> list[str]:
+    """
+    NAT rules (iptables-restore syntax) forwarding `fwds` to `ip`, forwards to
+    the same ports are merged into multiport rules
+    """
+    pre, post = CHAINS["PREROUTING"], CHAINS["POSTROUTING"]
+    rules = []
+    for protocol in ("tcp", "udp"):
+        same = [f for f in fwds if f.protocol == protocol and f.is_identity]
+        for chunk in _chunks(list(dict.fromkeys(same))):
+            if len(chunk) == 1:
+                match = f"--dport {_fmt(chunk[0].host_ports)}"
+            else:
+                ports = ",".join(_fmt(f.host_ports) for f in chunk)
+                match = f"-m multiport --dports {ports}"
+            rules.append(
+                f"-A {pre} -p {protocol} {match} -j DNAT --to-destination {ip}"
+            )
+            rules.append(f"-A {post} -d {ip} -p {protocol} {match} -j MASQUERADE")
+        for f in dict.fromkeys(fwds):
+            if f.protocol != protocol or f.is_identity:
+                continue
+            host_port, vm_port = _fmt(f.host_ports), _fmt(f.vm_ports)
+            rules.append(
+                f"-A {pre} -p {protocol} --dport {host_port} "
+                f"-j DNAT --to-destination {ip}:{vm_port}"
+            )
+            rules.append(
+                f"-A {post} -d {ip} -p {protocol} --dport {vm_port} -j MASQUERADE"
+            )
+    return rules
+
+
+def apply(fwds: list[PortForward], ip: str):
+    """
+    Replace our NAT chains with the rules of `fwds` in one iptables-restore
+    """
+    saved = utils.sh(["iptables-save", "-t", "nat"]).stdout.decode().splitlines()
+    lines = ["*nat"]
+    for chain in CHAINS.values():
+        lines += [f":{chain} - [0:0]", f"-F {chain}"]
+    for builtin, chain in CHAINS.items():
+        jump = f"-A {builtin} -j {chain}"
+        if jump not in saved:
+            lines.append(jump)
+    lines += build_rules(fwds, ip)
+    lines.append("COMMIT")
+    utils.sh(["iptables-restore", "--noflush"], input="\n".join(lines + [""]).encode())
@@ -0,0 +1,262 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import socket
+
+from . import service
+from .portfwd import PortForward
+
+log = logging.getLogger(__name__)
+
+MAX_CONNECTIONS = 1024  # concurrent tcp connections, more are closed on accept
+MAX_FLOWS = 256  # udp flows (client addresses), the least recent is evicted
+FLOW_TIMEOUT = 60  # seconds an idle udp flow is kept
+CHUNK_SIZE = 1 << 16  # default pipe capacity
+UDP_MAX_SIZE = 65535
+# zero-copy socket -> pipe -> socket, plain recv/send elsewhere
+HAS_SPLICE = hasattr(os, "splice")
+
+
+class Stats:
+    def __init__(self):
+        self.connections = 0  # tcp connections accepted
+        self.rejected = 0  # tcp connections over MAX_CONNECTIONS
+        self.active = 0  # open tcp connections
+        self.flows = 0  # udp flows created
+        self.bytes_in = 0  # host -> VM
+        self.bytes_out = 0  # VM -> host
+
+    def __str__(self):
+        return ", ".join(f"{k}={v}" for k, v in vars(self).items())
+
+
+class _Flow:
+    __slots__ = ("last_seen", "sock")
+
+    def __init__(self, sock: socket.socket, last_seen: float):
+        self.sock = sock
+        self.last_seen = last_seen
+
+
+async def _wait_fd(add, remove, fd: int):
+    fut = asyncio.get_running_loop().create_future()
+    add(fd, lambda: fut.done() or fut.set_result(None))
+    try:
+        await fut
+    finally:
+        remove(fd)
+
+
+class PortProxy(service.LoopService):
+    """
+    Forward host ports to the VM in userspace, for hosts without iptables NAT
+    """
+
+    name = "port-proxy"
+
+    def __init__(
+        self,
+        fwds: list[PortForward],
+        ip: str,
+        bind: str = "0.0.0.0",
+        max_connections: int = MAX_CONNECTIONS,
+        max_flows: int = MAX_FLOWS,
+    ):
+        super().__init__()
+        self.ip = ip
+        self.bind = bind
+        self.max_connections = max_connections
+        self.max_flows = max_flows
+        self.stats = Stats()
+        # (protocol, host_port) -> vm_port, ranges are forwarded port by port
+        self.ports: dict[tuple[str, int], int] = {}
+        for f in fwds:
+            offset = f.vm_ports[0] - f.host_ports[0]
+            for port in range(f.host_ports[0], f.host_ports[1] + 1):
+                self.ports[(f.protocol, port)] = port + offset
+        self._flows: list[collections.OrderedDict] = []
+
+    def spec(self) -> dict:
+        return {
+            "name": self.name,
+            "ports": [
+                [proto, port, vm_port] for (proto, port), vm_port in self.ports.items()
+            ],
+            "ip": self.ip,
+            "bind": self.bind,
+            "max_connections": self.max_connections,
+            "max_flows": self.max_flows,
+        }
+
+    @classmethod
+    def from_spec(cls, spec: dict) -> "PortProxy":
+        fwds = [
+            PortForward(p, (port, port), (vm_port, vm_port))
+            for p, port, vm_port in spec["ports"]
+        ]
+        return cls(
+            fwds,
+            spec["ip"],
+            bind=spec["bind"],
+            max_connections=spec["max_connections"],
+            max_flows=spec["max_flows"],
+        )
+
+    def stop(self):
+        if self._thread and self._thread.is_alive():
+            super().stop()
+            log.info(f"port proxy stopped: {self.stats}")
+
+    def _setup(self, loop: asyncio.AbstractEventLoop):
+        for (protocol, port), vm_port in self.ports.items():
+            kind = socket.SOCK_STREAM if protocol == "tcp" else socket.SOCK_DGRAM
+            sock = self._socket(kind)
+            sock.bind((self.bind, port))
+            target = (self.ip, vm_port)
+            if protocol == "tcp":
+                sock.listen(socket.SOMAXCONN)
+                self._spawn(self._serve_tcp(sock, target))
+            else:
+                flows: collections.OrderedDict = collections.OrderedDict()
+                self._flows.append(flows)
+                loop.add_reader(sock, self._on_datagram, sock, target, flows)
+        if self._flows:
+            loop.call_later(FLOW_TIMEOUT / 2, self._expire_flows)
+
+    def _teardown(self, loop: asyncio.AbstractEventLoop):
+        for flows in self._flows:
+            while flows:
+                self._close_flow(flows, next(iter(flows)))
+
+    # tcp
+
+    async def _serve_tcp(self, lsock: socket.socket, target: tuple[str, int]):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _ = await loop.sock_accept(lsock)
+            if self.stats.active >= self.max_connections:
+                self.stats.rejected += 1
+                conn.close()
+                continue
+            self.stats.connections += 1
+            self.stats.active += 1
+            self._spawn(self._relay(conn, target))
+
+    async def _relay(self, conn: socket.socket, target: tuple[str, int]):
+        loop = asyncio.get_running_loop()
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            upstream.setblocking(False)
+            await loop.sock_connect(upstream, target)
+            for s in (conn, upstream):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            await asyncio.gather(
+                self._pipe(conn, upstream, inbound=True),
+                self._pipe(upstream, conn, inbound=False),
+            )
+        except OSError as e:
+            log.debug(f"port proxy failed to connect {target}: {e}")
+        finally:
+            conn.close()
+            upstream.close()
+            self.stats.active -= 1
+
+    def _count(self, n: int, inbound: bool):
+        if inbound:
+            self.stats.bytes_in += n
+        else:
+            self.stats.bytes_out += n
+
+    async def _pipe(self, src: socket.socket, dst: socket.socket, inbound: bool):
+        try:
+            await (self._splice if HAS_SPLICE else self._copy)(src, dst, inbound)
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:  # reset, wake up the other direction
+            for s in (src, dst):
+                with contextlib.suppress(OSError):
+                    s.shutdown(socket.SHUT_RDWR)
+
+    async def _splice(self, src: socket.socket, dst: socket.socket, inbound: bool):
+        loop = asyncio.get_running_loop()
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        r, w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            while True:
+                try:
+                    n = os.splice(src.fileno(), w, CHUNK_SIZE, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(loop.add_reader, loop.remove_reader, src.fileno())
+                    continue
+                if not n:
+                    return
+                self._count(n, inbound)
+                while n:
+                    try:
+                        n -= os.splice(r, dst.fileno(), n, flags=flags)
+                    except BlockingIOError:
+                        await _wait_fd(
+                            loop.add_writer, loop.remove_writer, dst.fileno()
+                        )
+        finally:
+            os.close(r)
+            os.close(w)
+
+    async def _copy(self, src: socket.socket, dst: socket.socket, inbound: bool):
+        loop = asyncio.get_running_loop()
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        while n := await loop.sock_recv_into(src, buf):
+            self._count(n, inbound)
+            await loop.sock_sendall(dst, view[:n])
+
+    # udp
+
+    def _on_datagram(self, lsock: socket.socket, target, flows):
+        loop = self._loop
+        while True:
+            try:
+                data, addr = lsock.recvfrom(UDP_MAX_SIZE)
+            except OSError:  # drained, or an ICMP error
+                return
+            flow = flows.get(addr)
+            if flow is None:
+                if len(flows) >= self.max_flows:
+                    self._close_flow(flows, next(iter(flows)))
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setblocking(False)
+                sock.connect(target)
+                flow = flows[addr] = _Flow(sock, loop.time())
+                loop.add_reader(sock, self._on_reply, lsock, flow, addr)
+                self.stats.flows += 1
+            else:
+                flows.move_to_end(addr)
+                flow.last_seen = loop.time()
+            with contextlib.suppress(OSError):  # dropped like on the wire
+                flow.sock.send(data)
+                self.stats.bytes_in += len(data)
+
+    def _on_reply(self, lsock: socket.socket, flow: _Flow, addr):
+        while True:
+            try:
+                data = flow.sock.recv(UDP_MAX_SIZE)
+            except OSError:
+                return
+            flow.last_seen = self._loop.time()
+            with contextlib.suppress(OSError):
+                lsock.sendto(data, addr)
+                self.stats.bytes_out += len(data)
+
+    def _close_flow(self, flows: collections.OrderedDict, addr):
+        flow = flows.pop(addr)
+        self._loop.remove_reader(flow.sock)
+        flow.sock.close()
+
+    def _expire_flows(self):
+        loop = self._loop
+        deadline = loop.time() - FLOW_TIMEOUT
+        for flows in self._flows:
+            for addr in [a for a, f in flows.items() if f.last_seen < deadline]:
+                self._close_flow(flows, addr)
+        loop.call_later(FLOW_TIMEOUT / 2, self._expire_flows)
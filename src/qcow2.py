@@ -0,0 +1,105 @@
+import struct
+import typing
+
+MAGIC = b"QFI\xfb"
+# magic, version, backing file offset/size, cluster_bits, size
+HEADER = struct.Struct(">4sIQIIQ")
+# incompatible, compatible, autoclear features, refcount_order, header length
+HEADER_V3 = struct.Struct(">QQQII")
+HEADER_V3_OFFSET = 72
+EXTENDED_L2 = 1 << 4  # incompatible feature bit
+MIN_L2_CACHE_CLUSTERS = 2  # Qemu rejects smaller caches
+MIN_REFCOUNT_CACHE_CLUSTERS = 4
+
+
+class Info(typing.NamedTuple):
+    size: int  # virtual size
+    cluster_size: int
+    refcount_bits: int = 16
+    extended_l2: bool = False
+    backing_file: str | None = None  # as written, may be relative to the image
+
+
+class CacheSizes(typing.NamedTuple):
+    l2: int
+    refcount: int
+
+    def options(self) -> dict[str, int]:
+        return {"l2-cache-size": self.l2, "refcount-cache-size": self.refcount}
+
+
+def read_info(file: str) -> Info | None:
+    """
+    Geometry from the header of a qcow2 image, None if it isn't one
+    """
+    try:
+        with open(file, "rb") as f:
+            data = f.read(HEADER_V3_OFFSET + HEADER_V3.size)
+            if len(data) < HEADER.size:
+                return None
+            magic, version, backing_offset, backing_size, cluster_bits, size = (
+                HEADER.unpack_from(data)
+            )
+            if magic != MAGIC:
+                return None
+            backing_file = None
+            if backing_offset:
+                f.seek(backing_offset)
+                backing_file = f.read(backing_size).decode(errors="replace")
+    except OSError:
+        return None
+    if version < 3 or len(data) < HEADER_V3_OFFSET + HEADER_V3.size:
+        return Info(size, 1 << cluster_bits, backing_file=backing_file)
+    incompatible, _, _, refcount_order, _ = HEADER_V3.unpack_from(
+        data, HEADER_V3_OFFSET
+    )
+    return Info(
+        size,
+        1 << cluster_bits,
+        refcount_bits=1 << refcount_order,
+        extended_l2=bool(incompatible & EXTENDED_L2),
+        backing_file=backing_file,
+    )
+
+
+def _round_up(n: int, m: int) -> int:
+    return -(-n // m) * m
+
+
+def cache_sizes(info: Info, budget: int) -> CacheSizes:
+    """
+    Caches covering every L2 table and the refcount blocks of a fully
+    allocated image, scaled down together to fit `budget` bytes
+    """
+    clusters = -(-info.size // info.cluster_size)
+    l2 = clusters * (16 if info.extended_l2 else 8)
+    refcount = clusters * info.refcount_bits // 8
+    total = l2 + refcount
+    if total > budget:
+        l2, refcount = l2 * budget // total, refcount * budget // total
+    cs = info.cluster_size
+    return CacheSizes(
+        l2=max(_round_up(l2, cs), MIN_L2_CACHE_CLUSTERS * cs),
+        refcount=max(_round_up(refcount, cs), MIN_REFCOUNT_CACHE_CLUSTERS * cs),
+    )
+
+
+def create_options(
+    cluster_size: str | None = None,
+    preallocation: str | None = None,
+    lazy_refcounts: bool = False,
+    extended_l2: bool = False,
+) -> list[str]:
+    """
+    'qemu-img create -o' options of a qcow2 image
+    """
+    opts = []
+    if cluster_size:
+        opts.append(f"cluster_size={cluster_size}")
+    if preallocation:
+        opts.append(f"preallocation={preallocation}")
+    if lazy_refcounts:
+        opts.append("lazy_refcounts=on")
+    if extended_l2:
+        opts.append("extended_l2=on")
+    return opts
@@ -0,0 +1,76 @@
+import json
+import random
+import socket
+
+
+class QmpError(RuntimeError):
+    pass
+
+
+class Qmp:
+    """
+    Minimal QMP client, commands are executed one by one and events are skipped
+    """
+
+    def __init__(self, addr: tuple[str, int], timeout: float = 5):
+        self.sock = socket.create_connection(addr, timeout=timeout)
+        self.file = self.sock.makefile("rwb")
+        self._read()  # greeting
+        self.execute("qmp_capabilities")
+
+    def _read(self) -> dict:
+        line = self.file.readline()
+        if not line:
+            raise QmpError("connection closed by Qemu")
+        return json.loads(line)
+
+    def execute(self, cmd: str, **args) -> dict:
+        msg: dict = {"execute": cmd}
+        if args:
+            msg["arguments"] = args
+        self.file.write(json.dumps(msg).encode() + b"\n")
+        self.file.flush()
+        while True:
+            resp = self._read()
+            if "error" in resp:
+                raise QmpError(f"'{cmd}' failed: {resp['error'].get('desc')}")
+            if "return" in resp:
+                return resp["return"]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class GuestAgent(Qmp):
+    """
+    Client of the Qemu guest agent on its chardev socket, it has no greeting, the
+    stream is synced past replies left by earlier clients instead
+    """
+
+    def __init__(self, path: str, timeout: float = 5):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.file = self.sock.makefile("rwb")
+        sync_id = random.randrange(1 << 31)
+        self.file.write(
+            json.dumps({"execute": "guest-sync", "arguments": {"id": sync_id}}).encode()
+            + b"\n"
+        )
+        self.file.flush()
+        while self._read().get("return") != sync_id:
+            pass
+
+    def settimeout(self, timeout: float | None):
+        self.sock.settimeout(timeout)
@@ -7,7 +7,7 @@ import typing
 import click
 import typer
 
-from . import meta, vm
+from . import backing, imagecache, meta, plan, qcow2, trace, virtiofs, vm
 
 log = logging.getLogger(__name__)
 
@@ -23,7 +23,18 @@ app = typer.Typer(
 )
 
 
-QEMU_ARCHS = vm.get_qemu_archs()
+class LazyChoice(click.Choice):
+    """
+    Choice whose values are discovered on use, not at import time
+    """
+
+    def __init__(self, get_choices, case_sensitive: bool = True):
+        self.get_choices = get_choices
+        self.case_sensitive = case_sensitive
+
+    @property
+    def choices(self):
+        return tuple(self.get_choices())
 
 
 def str_or_none(value: str):
@@ -37,14 +48,28 @@ def main(
     cpu_num: int = typer.Option(None, "-c", "--cpu", help="CPU cores"),
     mem_size: int = typer.Option(None, "-m", "--mem", min=1, help="Memory size in MB"),
     arch: str = typer.Option(
-        default="x86_64", help="VM arch", click_type=click.Choice(QEMU_ARCHS)
+        default="x86_64", help="VM arch", click_type=LazyChoice(vm.get_qemu_archs)
+    ),
+    iso: str = typer.Option(
+        default=None,
+        help="ISO file path or url, urls are downloaded once into STORAGE_DIR "
+        "(e.g. https://host/x.iso#sha256=<hex>)",
     ),
-    iso: str = typer.Option(default=None, help="ISO file path or drive url"),
     accel: bool = typer.Option(default=True, help="Enable acceleration"),
     macvlan: bool = typer.Option(
         default=False, help="Enable macvlan network, otherwise use bridge network"
     ),
+    passt: bool = typer.Option(
+        default=False,
+        help="Enable passt user-mode network, no 'NET_ADMIN' needed (overrides macvlan)",
+    ),
     netdev: bool = typer.Option(default=True, help="Setup netdev or not"),
+    net_queues: int = typer.Option(
+        None,
+        min=1,
+        help="virtio-net queues per NIC [default: CPU cores, up to 8]",
+        show_default=False,
+    ),
     dhcp: bool = typer.Option(default=True, help="Enable DHCP"),
     vnc_web: bool = typer.Option(default=True, help="Enable VNC web client (noVNC)"),
     console: bool = typer.Option(
@@ -73,7 +98,36 @@ def main(
         help="(multiple) Special VM network CIDR (IPv4) (e.g. 192.168.1.0/24)",
     ),
     dry: bool = typer.Option(default=False, help="Dry run"),
+    exec_: bool = typer.Option(
+        True,
+        "--exec/--no-exec",
+        help="Replace this process with Qemu, otherwise supervise it",
+    ),
+    profile: bool = typer.Option(
+        default=False, help="Trace startup phases into STORAGE_DIR and log a summary"
+    ),
+    save_state: bool = typer.Option(
+        default=False,
+        help="Save the VM state on SIGTERM and resume from it on the next run "
+        "(needs '--console' and a container stop timeout long enough to save RAM)",
+    ),
+    compact_interval: float = typer.Option(
+        None,
+        min=0.1,
+        help="Hours between background trims of the VM disks by the guest agent, "
+        "done while the disks are idle",
+    ),
+    plan_file: pathlib.Path = typer.Option(
+        None,
+        "--plan",
+        help="Launch plan file, executed directly if the inputs (options, settings, "
+        "host network) are unchanged, otherwise written by this run",
+    ),
 ):
+    if plan_file and (p := plan.load(plan_file)):
+        log.info(f"Executing launch plan {plan_file} ...")
+        plan.execute(p, replace=exec_, dry=dry)
+        raise typer.Exit()
     meta.config.update(
         arch=arch,
         mem_size=mem_size,
@@ -82,17 +136,26 @@ def main(
         vga=vga,
         enable_accel=accel,
         enable_macvlan=macvlan,
+        enable_passt=passt,
         enable_dhcp=dhcp,
         enable_vnc_web=vnc_web,
         enable_console=console,
         setup_netdev=netdev,
+        net_queues=net_queues,
         machine=machine,
         boot_mode=boot_mode,
         boot=boot,
         ifaces=ifaces,
         networks=[ipaddress.IPv4Network(n, strict=False) for n in networks],
         dry_run=dry,
+        exec_qemu=exec_,
+        profile=profile,
+        plan_file=plan_file,
+        save_state=save_state,
+        compact_interval=compact_interval,
     )
+    if profile:
+        trace.enable()
 
 
 @app.command()
@@ -112,17 +175,15 @@ def windows(
         )
     c = meta.config
     c.win_opts = meta.WinOpts(virtio_iso=virtio_iso, enable_tmp=tpm)
-    if virtio_iso:
+    if virtio_iso and not imagecache.is_url(virtio_iso):  # urls are downloaded first
         c.qemu.append({"drive": f"file={virtio_iso},if=ide,media=cdrom,readonly=on"})
-    if tpm:
-        try:
-            vm.setup_swtpm()
-        except Exception:
-            log.warning("failed to setup swtpm, ignore TPM support")
     if c.boot_mode == meta.BootMode.LEGACY:
         c.boot_mode = meta.BootMode.WINDOWS
 
 
+DEFAULT_DISK_SIZE = "16G"
+
+
 def gen_disk_name(sn: str, type="qcow2"):
     vm_id = vm.get_vm_id()
     return f"{vm_id}@{sn}.{type}"
@@ -131,31 +192,168 @@ def gen_disk_name(sn: str, type="qcow2"):
 @app.command()
 def apply_disk(
     name: str = typer.Option(..., "-n", "--name", help="Disk name (e.g. disk1)"),
-    size: str = typer.Option("16G", "-s", "--size", help="Disk size (e.g. 32G)"),
+    size: str = typer.Option(
+        None,
+        "-s",
+        "--size",
+        help=f"Disk size (e.g. 32G), {DEFAULT_DISK_SIZE} or the size of '--base'",
+    ),
     file_type: str = typer.Option("qcow2", help="Drive file type (e.g. qcow2,raw)"),
     if_type: str = typer.Option(None, help="Drive interface type (e.g. virtio,ide)"),
     opts: str = typer.Option(
         None, help="External drive options (e.g. index=i,format=f)"
     ),
+    io_profile: meta.IoProfile = typer.Option(
+        meta.IoProfile.DEFAULT,
+        help="I/O tuning, profiles other than 'default' attach a virtio-blk "
+        "device with an iothread, io_uring and direct I/O",
+    ),
+    cluster_size: str = typer.Option(
+        None, help="qcow2 cluster size of a new disk (e.g. 64K,2M)"
+    ),
+    preallocation: meta.Preallocation = typer.Option(
+        None, help="Preallocation of a new disk"
+    ),
+    lazy_refcounts: bool = typer.Option(
+        False, help="Defer qcow2 refcount updates of a new disk"
+    ),
+    extended_l2: bool = typer.Option(
+        False, help="qcow2 subclusters of a new disk, for large clusters"
+    ),
+    qcow2_cache: int = typer.Option(
+        32,
+        min=0,
+        help="Max qcow2 L2 and refcount cache in MB, sized to the disk, "
+        "0 keeps Qemu's default",
+    ),
+    base: str = typer.Option(
+        None,
+        help="Create the disk as a qcow2 overlay of a shared read-only image, "
+        f"names are looked up in {backing.BASE_DIR}",
+    ),
 ):
     """Apply VM disk"""
     c = meta.config
+    if opts and io_profile != meta.IoProfile.DEFAULT:
+        raise click.UsageError("'--opts' can't be used with '--io-profile'")
+    create_opts = []
+    if file_type == "qcow2":
+        create_opts = qcow2.create_options(
+            cluster_size, preallocation, lazy_refcounts, extended_l2
+        )
+    elif cluster_size or lazy_refcounts or extended_l2:
+        raise click.UsageError(f"'{file_type}' disks don't have qcow2 options")
+    elif preallocation == meta.Preallocation.METADATA:
+        raise click.UsageError("'--preallocation metadata' needs a qcow2 disk")
+    elif preallocation:
+        create_opts = [f"preallocation={preallocation}"]
+    if base:
+        if file_type != "qcow2":
+            raise click.UsageError("'--base' needs a qcow2 disk")
+        if preallocation:
+            raise click.UsageError("'--preallocation' can't be used with '--base'")
+        try:
+            base = backing.resolve(base)
+        except FileNotFoundError as e:
+            raise click.UsageError(str(e)) from e
+    disk_name = name
     name = gen_disk_name(name, file_type)
     drive_file = os.path.join(meta.STORAGE_DIR, name)
     if_type = "virtio"
     if c.is_win and not c.win_opts.virtio_iso:
         if_type = "ide"
     if not os.path.exists(drive_file):
-        vm.create_drive(drive_file, size, file_type)
+        if base:
+            backing.create_overlay(base, drive_file, size, create_opts)
+        else:
+            size = size or DEFAULT_DISK_SIZE
+            vm.create_drive(drive_file, size, file_type, create_opts)
     else:
         log.info(f"{drive_file} already exists, skip creating")
+    if base:
+        backing.check_overlay(base, drive_file)
+        n = backing.acquire(base, drive_file)
+        log.info(f"{drive_file} is one of the {n} overlays of {base}")
+    format_opts = {}
+    # the geometry of an existing disk may differ from the options
+    if (
+        file_type == "qcow2"
+        and qcow2_cache
+        and "cache-size" not in (opts or "")
+        and (info := qcow2.read_info(drive_file))
+    ):
+        format_opts = qcow2.cache_sizes(info, qcow2_cache << 20).options()
+    if io_profile != meta.IoProfile.DEFAULT:
+        if if_type == "virtio":
+            vm.configure_drive(
+                disk_name, drive_file, file_type, io_profile, format_opts
+            )
+            return
+        log.warning(f"'{if_type}' disks don't support '--io-profile', ignore it")
     v = f"file={drive_file},if={if_type}"
+    if "discard" not in (opts or ""):
+        # space freed by the guest (TRIM) is returned to the storage
+        v += ",discard=unmap"
+    v += "".join(f",{k}={n}" for k, n in format_opts.items())
     if opts:
         v += "," + opts
     c.qemu.append({"drive": v})
     return
 
 
+DEFAULT_MEM_SIZE = 128  # MB, Qemu's default
+
+
+@app.command()
+def share_dir(
+    path: pathlib.Path = typer.Option(
+        ...,
+        "-p",
+        "--path",
+        exists=True,
+        file_okay=False,
+        resolve_path=True,
+        help="Host directory",
+    ),
+    tag: str = typer.Option(
+        None, "-t", "--tag", help="Mount tag in the guest [default: the dir name]"
+    ),
+    cache: meta.FsCache = typer.Option(meta.FsCache.AUTO, help="Guest cache mode"),
+    thread_pool_size: int = typer.Option(
+        None, min=0, help="virtiofsd workers [default: 2 per CPU core, up to 32]"
+    ),
+    dax_window: str = typer.Option(
+        None, help="DAX window (e.g. 4G), needs a Qemu with virtio-fs DAX support"
+    ),
+    readonly: bool = typer.Option(False, help="Share read-only"),
+):
+    """Share a host directory by virtiofs"""
+    c = meta.config
+    tag = path.name if tag is None else tag
+    if not virtiofs.TAG_REGEX.fullmatch(tag):
+        raise click.UsageError(
+            f"tag '{tag}' may only have letters, digits, '_', '.' and '-', set it by -t"
+        )
+    if len(tag.encode()) > virtiofs.MAX_TAG_LENGTH:
+        raise click.UsageError(f"tag '{tag}' is longer than 36 bytes")
+    if any(s.tag == tag for s in c.shares):
+        raise click.UsageError(f"tag '{tag}' is already shared")
+    if not c.mem_size:
+        # the shared memory backend must have the size of the guest RAM
+        c.mem_size = DEFAULT_MEM_SIZE
+    c.shares.append(
+        meta.Share(
+            path=str(path),
+            tag=tag,
+            cache=cache,
+            thread_pool_size=thread_pool_size,
+            dax_window=dax_window,
+            readonly=readonly,
+        )
+    )
+    log.info(f"'mount -t virtiofs {tag} <dir>' in the guest to mount {path}")
+
+
 @app.command()
 def ext_args(args: list[str] = typer.Argument(..., help="External Qemu args")):
     """External Qemu args"""
@@ -167,10 +365,21 @@ def ext_args(args: list[str] = typer.Argument(..., help="External Qemu args")):
 @app.command()
 def port_forward(
     ports: list[str] = typer.Option(
-        None, "-p", "--port", help="(multiple) Port forward spec (e.g. 80:8088)"
+        None,
+        "-p",
+        "--port",
+        help="(multiple) Port forward spec (e.g. 80:8088, 53/udp, 5900-5910)",
+    ),
+    proxy: typing.Optional[bool] = typer.Option(
+        None,
+        "--proxy/--no-proxy",
+        help="Forward in userspace instead of iptables NAT [default: if NAT fails]",
+        show_default=False,
     ),
 ):
     """Forward VM ports"""
+    if proxy is not None:
+        meta.config.port_proxy = proxy
     if meta.config.port_forwards is None:
         meta.config.port_forwards = ports
         return
@@ -0,0 +1,155 @@
+import ipaddress
+import itertools
+import logging
+import os
+import select
+import socket
+import struct
+import time
+from collections.abc import Iterable, Iterator
+
+from . import host, trace
+
+log = logging.getLogger(__name__)
+
+SCAN_CONCURRENCY = 64
+SCAN_BUDGET = 10.0  # seconds
+ARP_TIMEOUT = 0.3
+ARP_RETRIES = 2
+PING_TIMEOUT = 1
+
+ETH_P_ARP = 0x0806
+ETH_P_IP = 0x0800
+ARP_REQUEST = 1
+ARP_REPLY = 2
+BROADCAST_MAC = b"\xff" * 6
+
+
+def iter_hosts(network: ipaddress.IPv4Network, reverse=True) -> Iterator[str]:
+    """
+    Lazily yield host addresses of `network`, highest first by default
+    """
+    first = int(network.network_address)
+    last = int(network.broadcast_address)
+    if network.prefixlen < 31:  # skip network and broadcast address
+        first, last = first + 1, last - 1
+    ints = range(last, first - 1, -1) if reverse else range(first, last + 1)
+    for i in ints:
+        yield str(ipaddress.IPv4Address(i))
+
+
+def _get_mac(iface: str) -> bytes:
+    with open(f"/sys/class/net/{iface}/address") as f:
+        return bytes.fromhex(f.read().strip().replace(":", ""))
+
+
+def _arp_probe_frame(src_mac: bytes, ip: str) -> bytes:
+    # RFC 5227 probe: sender ip 0.0.0.0, we don't need an address on the iface
+    eth = BROADCAST_MAC + src_mac + struct.pack("!H", ETH_P_ARP)
+    arp = struct.pack("!HHBBH", 1, ETH_P_IP, 6, 4, ARP_REQUEST)
+    arp += src_mac + bytes(4) + bytes(6) + socket.inet_aton(ip)
+    return eth + arp
+
+
+def _arp_reply_sender(frame: bytes) -> str | None:
+    if len(frame) < 42 or struct.unpack("!H", frame[12:14])[0] != ETH_P_ARP:
+        return None
+    if struct.unpack("!H", frame[20:22])[0] != ARP_REPLY:
+        return None
+    return socket.inet_ntoa(frame[28:32])
+
+
+def arp_scan(iface: str, ips: list[str], timeout: float = ARP_TIMEOUT) -> set[str]:
+    """
+    Send ARP probes for `ips` over one raw socket, return the addresses which replied
+    """
+    alive: set[str] = set()
+    src_mac = _get_mac(iface)
+    with socket.socket(
+        socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP)
+    ) as sock:
+        sock.bind((iface, 0))
+        sock.setblocking(False)
+        wanted = set(ips)
+        for _ in range(ARP_RETRIES):
+            for ip in wanted - alive:
+                sock.send(_arp_probe_frame(src_mac, ip))
+            deadline = time.monotonic() + timeout
+            while (remain := deadline - time.monotonic()) > 0 and alive != wanted:
+                r, _, _ = select.select([sock], [], [], remain)
+                if not r:
+                    break
+                ip = _arp_reply_sender(sock.recv(65535))
+                if ip in wanted:
+                    alive.add(ip)
+            if alive == wanted:
+                break
+    return alive
+
+
+def ping_scan(ips: list[str], concurrency: int = SCAN_CONCURRENCY) -> set[str]:
+    """
+    Ping `ips` concurrently, return the addresses which replied
+    """
+    import asyncio  # only needed by the fallback, keep it out of the cli startup
+
+    async def _ping(ip: str, sem: asyncio.Semaphore) -> bool:
+        argv = ["ping", "-c", "1", "-W", str(PING_TIMEOUT), ip]
+        async with sem:
+            start, returncode = time.perf_counter(), None
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+                returncode = await proc.wait()
+            finally:
+                trace.record_subprocess(argv, start, time.perf_counter(), returncode)
+            return returncode == 0
+
+    async def _ping_scan() -> set[str]:
+        sem = asyncio.Semaphore(concurrency)
+        rets = await asyncio.gather(*(_ping(ip, sem) for ip in ips))
+        return {ip for ip, ok in zip(ips, rets) if ok}
+
+    return asyncio.run(_ping_scan())
+
+
+def probe(ips: list[str], iface: str | None = None) -> set[str]:
+    """
+    Return alive addresses in `ips`, prefer ARP and fallback to ICMP
+    """
+    if iface and os.path.exists(f"/sys/class/net/{iface}"):
+        try:
+            return arp_scan(iface, ips)
+        except PermissionError:
+            log.debug("no permission for raw socket, fallback to ping")
+        except OSError as e:
+            log.debug(f"arp scan on {iface} failed ({e}), fallback to ping")
+    return ping_scan(ips)
+
+
+def find_unused_ip(
+    candidates: Iterable[str],
+    iface: str | None = None,
+    exclude: Iterable[str] = (),
+    concurrency: int = SCAN_CONCURRENCY,
+    budget: float = SCAN_BUDGET,
+) -> str | None:
+    """
+    Probe `candidates` in windows of `concurrency`, return the first one (in order)
+    without an owner, or None if the candidates or the time budget run out
+    """
+    excluded = set(exclude)
+    it = (ip for ip in candidates if ip not in excluded)
+    deadline = time.monotonic() + budget
+    while window := list(itertools.islice(it, concurrency)):
+        alive = host.current().probe(window, iface)
+        for ip in window:
+            if ip not in alive:
+                return ip
+        if time.monotonic() > deadline:
+            log.warning(f"ip scan exceeds the time budget ({budget}s)")
+            break
+    return None
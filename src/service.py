@@ -0,0 +1,169 @@
+import abc
+import asyncio
+import contextlib
+import ctypes
+import logging
+import os
+import signal
+import socket
+import threading
+
+log = logging.getLogger(__name__)
+
+KINDS: dict[str, type["LoopService"]] = {}
+PR_SET_PDEATHSIG = 1
+STOP_SIGNALS = {signal.SIGINT, signal.SIGTERM, signal.SIGHUP}
+
+
+class LoopService(abc.ABC):
+    """
+    An asyncio service in a daemon thread, for the host services which have to
+    outlive the startup. They run beside a supervised Qemu, or in a `detach`ed
+    child when Qemu replaces this process.
+    """
+
+    name = "service"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        KINDS[cls.name] = cls
+
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._socks: list[socket.socket] = []
+        self._tasks: set[asyncio.Task] = set()
+
+    @abc.abstractmethod
+    def _setup(self, loop: asyncio.AbstractEventLoop):
+        """
+        Bind sockets and schedule the work, before the loop is running
+        """
+
+    def _teardown(self, loop: asyncio.AbstractEventLoop):
+        pass
+
+    @abc.abstractmethod
+    def spec(self) -> dict:
+        """
+        JSON-able arguments to recreate the service by `from_spec`, for launch plans
+        """
+
+    @classmethod
+    @abc.abstractmethod
+    def from_spec(cls, spec: dict) -> "LoopService":
+        pass
+
+    def start(self):
+        """
+        Set up the service and serve it in the background, setup errors are raised
+        """
+        loop = self._loop = asyncio.new_event_loop()
+        try:
+            self._setup(loop)  # the loop isn't running yet, any thread can set it up
+        except BaseException:
+            self._shutdown(loop)
+            raise
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not (self._loop and self._thread and self._thread.is_alive()):
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def _run(self):
+        loop = self._loop
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            self._shutdown(loop)
+
+    def _shutdown(self, loop: asyncio.AbstractEventLoop):
+        if tasks := list(self._tasks):
+            for t in tasks:
+                t.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._teardown(loop)
+        for s in self._socks:
+            with contextlib.suppress(ValueError):
+                loop.remove_reader(s)
+            s.close()
+        loop.close()
+
+    def _socket(self, kind: int) -> socket.socket:
+        """
+        A non-blocking socket, closed with the service
+        """
+        sock = socket.socket(socket.AF_INET, kind)
+        self._socks.append(sock)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(False)
+        return sock
+
+    def _spawn(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+def from_spec(spec: dict) -> LoopService:
+    return KINDS[spec["name"]].from_spec(spec)
+
+
+def detach(services: list[LoopService], close_fds: list[int] = ()) -> int:
+    """
+    Serve `services` in a forked child, so Qemu can replace this process. The
+    child stops them and exits with its parent. Return its pid once they are set
+    up, setup errors are raised.
+    """
+    parent = os.getpid()
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        _serve_detached(services, close_fds, parent, w)
+    os.close(w)
+    with os.fdopen(r) as f:
+        msg = f.readline()
+    if msg != "\n":
+        os.waitpid(pid, 0)
+        raise EnvironmentError(f"failed to start services: {msg.strip() or 'exited'}")
+    log.info(f"Serving {', '.join(s.name for s in services)} in process {pid}")
+    return pid
+
+
+def _serve_detached(services, close_fds, parent: int, ready_fd: int):
+    code = 0
+    try:
+        # the fds are Qemu's, and the stop signals are taken by `sigwait`
+        for fd in close_fds:
+            with contextlib.suppress(OSError):
+                os.close(fd)
+        signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM) != 0:
+            raise OSError(ctypes.get_errno(), "prctl(PR_SET_PDEATHSIG) failed")
+        if os.getppid() != parent:  # died before prctl
+            return
+        with contextlib.ExitStack() as stack:
+            for s in services:
+                stack.enter_context(s)
+            os.write(ready_fd, b"\n")
+            os.close(ready_fd)
+            signal.sigwait(STOP_SIGNALS)
+    except OSError as e:  # e.g. a port in use, other errors read as 'exited'
+        code = 1
+        with contextlib.suppress(OSError):
+            os.write(ready_fd, f"{e}\n".encode())
+    finally:
+        os._exit(code)
@@ -0,0 +1,118 @@
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_start = time.perf_counter()
+_enabled = False
+_events: list[dict] = []
+_lock = threading.Lock()
+_phase: contextvars.ContextVar[str] = contextvars.ContextVar("phase", default="main")
+
+
+def enable(on: bool = True):
+    """
+    Start collecting events into an empty trace, nothing is kept while disabled
+    """
+    global _enabled
+    with _lock:
+        _enabled = on
+        _events.clear()
+
+
+def _us(t: float) -> int:
+    return int((t - _start) * 1e6)
+
+
+def _record(event: dict):
+    with _lock:
+        if _enabled:
+            _events.append(event)
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """
+    Trace a startup phase, subprocesses spawned inside are accounted to it
+    """
+    token = _phase.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _phase.reset(token)
+        _record(
+            {
+                "name": name,
+                "cat": "phase",
+                "ph": "X",
+                "ts": _us(start),
+                "dur": _us(end) - _us(start),
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+            }
+        )
+
+
+def record_subprocess(args, start: float, end: float, returncode: int | None):
+    cmd = args if isinstance(args, str) else " ".join(str(a) for a in args)
+    _record(
+        {
+            "name": cmd.split()[0] if cmd else "?",
+            "cat": "subprocess",
+            "ph": "X",
+            "ts": _us(start),
+            "dur": _us(end) - _us(start),
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": {"cmd": cmd, "returncode": returncode, "phase": _phase.get()},
+        }
+    )
+
+
+def summary() -> list[dict]:
+    """
+    Per phase wall time, subprocess count and time spent in subprocesses (ms)
+    """
+    rows: dict[str, dict] = collections.defaultdict(
+        lambda: {"wall": 0.0, "subprocs": 0, "subproc_time": 0.0}
+    )
+    with _lock:
+        events = list(_events)
+    for e in events:
+        if e["cat"] == "phase":
+            rows[e["name"]]["wall"] += e["dur"] / 1000
+        else:
+            row = rows[e["args"]["phase"]]
+            row["subprocs"] += 1
+            row["subproc_time"] += e["dur"] / 1000
+    return [{"phase": name, **row} for name, row in rows.items()]
+
+
+def log_summary():
+    lines = [f"{'phase':<16}{'wall(ms)':>12}{'subprocs':>10}{'subproc(ms)':>14}"]
+    for r in sorted(summary(), key=lambda r: -r["wall"]):
+        lines.append(
+            f"{r['phase']:<16}{r['wall']:>12.1f}{r['subprocs']:>10}"
+            f"{r['subproc_time']:>14.1f}"
+        )
+    log.info("startup trace:\n" + "\n".join(lines))
+
+
+def dump_chrome_trace(path: str):
+    """
+    Write events in Chrome trace format (chrome://tracing, Perfetto)
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with _lock:
+        events = list(_events)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    log.info(f"startup trace is written to {path}")
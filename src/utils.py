@@ -1,9 +1,15 @@
+import contextlib
+import fcntl
 import ipaddress
+import json
 import logging
 import os
 import random
-import re
+import socket
 import subprocess
+import time
+
+from . import host, netinfo, trace
 
 log = logging.getLogger(__name__)
 
@@ -12,20 +18,28 @@ def sh(*args, **kwargs):
     kwargs.setdefault("stdout", subprocess.PIPE)
     kwargs.setdefault("stderr", subprocess.PIPE)
     kwargs.setdefault("check", True)
+    cmd = args[0] if args else kwargs.get("args", "")
     if len(args) == 1 and isinstance(args[0], str):
         args = [["bash", "-c", args[0]]]
-    return subprocess.run(*args, **kwargs)
-
-
-def is_kvm_avaliable():
-    return sh("grep -E 'svm|vmx' /proc/cpuinfo", check=False).returncode == 0
+    start, returncode = time.perf_counter(), None
+    try:
+        ret = host.current().run(*args, **kwargs)
+        returncode = ret.returncode
+        return ret
+    except subprocess.CalledProcessError as e:
+        returncode = e.returncode
+        raise
+    finally:
+        trace.record_subprocess(cmd, start, time.perf_counter(), returncode)
 
 
 def check_linux_capability(cap: str):
     cap = cap.lower()
     if not cap.startswith("cap_"):
         cap = "cap_" + cap
-    return sh(f"capsh --print | grep '!{cap}'", check=False).returncode != 0
+    with host.unrecorded():
+        ret = sh(f"capsh --print | grep '!{cap}'", check=False)
+    return ret.returncode != 0
 
 
 def gen_random_mac():
@@ -43,61 +57,52 @@ def gen_non_conflicting_ip(ip: str, cidr: int):
 
 
 def list_interfaces():
-    ret = sh(
-        "ip link show | grep -v noop | grep state "
-        "| grep -v LOOPBACK | awk '{print $2}' | tr -d : | sed 's/@.*$//'"
-    )
-    return set(x.strip() for x in ret.stdout.decode().split())
+    inv = netinfo.get()
+    return {name for name, i in inv.interfaces.items() if not i.is_loopback}
 
 
 def list_nameservers():
-    ret = sh("grep nameserver /etc/resolv.conf | sed 's/nameserver //'")
-    return [i.strip() for i in ret.stdout.decode().splitlines()]
+    return list(netinfo.get().nameservers)
 
 
 def get_default_route():
-    ret = sh("ip route | grep default | awk '{print $3}'")
-    return ret.stdout.decode().strip()
+    return netinfo.get().default_gateway
 
 
 def get_default_interface():
-    ret = sh("ip route | grep default | awk '{print $5}'")
-    return ret.stdout.decode().strip()
+    return netinfo.get().default_interface
 
 
 def get_hostname():
-    return sh("hostname -s").stdout.decode().strip()
-
-
-ip_addr_iface_ip_cidr = re.compile(r"inet\s+(.+)\s+brd")
-ip_addr_iface_mac = re.compile(r"link/ether\s+(.+)\s+brd")
+    return socket.gethostname().split(".")[0]
 
 
 def get_interface_info(iface):
-    ret = sh(f"ip address show dev {iface}")
-    info = ret.stdout.decode()
-    ip_cidr_list = ip_addr_iface_ip_cidr.findall(info)  # ip/cidr
-    macs = ip_addr_iface_mac.findall(info)
-    if not macs:
-        raise ValueError(f"cannot find mac for {iface}, output: {info}")
-    mac = macs[0]
-    return ip_cidr_list, mac
-
-
-def is_host_avaliable(ip, times: int = 1, timeout: float = 1):
-    return os.system(f"ping -c {times} -W {timeout} {ip} >/dev/null") == 0
-
-
-def get_qemu_accels(arch: str):
-    ret = sh(f"qemu-system-{arch} -accel help | tail -n +2")
-    return [i.strip() for i in ret.stdout.decode().splitlines()]
-
-
-def get_qemu_machines(arch: str, active_only=False):
-    if active_only:
-        ret = sh(
-            f"qemu-system-{arch} -machine help | tail -n +2 | grep alias | awk '{{print $1}}'"
-        )
-    else:
-        ret = sh(f"qemu-system-{arch} -machine help | tail -n +2 | awk '{{print $1}}'")
-    return [i.strip() for i in ret.stdout.decode().splitlines()]
+    info = netinfo.get().interfaces.get(iface)
+    if info is None or not info.mac:
+        raise ValueError(f"cannot find mac for {iface}, interface: {info}")
+    return list(info.ipnets), info.mac
+
+
+@contextlib.contextmanager
+def locked_json(file: str):
+    """
+    The dict in `file`, locked against other processes (e.g. containers sharing
+    the storage) and saved on exit
+    """
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(file) as f:
+                d = json.load(f)
+        except FileNotFoundError:
+            d = {}
+        except ValueError:
+            log.warning(f"invalid {file}, rebuild it")
+            d = {}
+        yield d
+        tmp_file = file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(d, f, indent=2)
+        os.replace(tmp_file, file)
@@ -0,0 +1,63 @@
+import logging
+import re
+import shlex
+import shutil
+
+from . import host, meta, utils
+
+log = logging.getLogger(__name__)
+
+RUN_DIR = "/run"
+START_TIMEOUT = 5  # seconds
+# Debian installs it out of PATH
+BINARIES = ["virtiofsd", "/usr/libexec/virtiofsd", "/usr/lib/qemu/virtiofsd"]
+MAX_THREAD_POOL = 32
+MAX_TAG_LENGTH = 36  # bytes, virtio-fs config space
+# the tag names files under RUN_DIR and is a Qemu option value
+TAG_REGEX = re.compile(r"[A-Za-z0-9_.-]+")
+
+
+def find_binary() -> str:
+    return next((b for b in BINARIES if shutil.which(b)), BINARIES[0])
+
+
+def thread_pool_size(share: meta.Share) -> int:
+    """
+    Two workers per vCPU, so requests from every vCPU are served while others
+    block on the host filesystem
+    """
+    if share.thread_pool_size is not None:
+        return share.thread_pool_size
+    return min(2 * (meta.config.cpu_num or 1), MAX_THREAD_POOL)
+
+
+def start(share: meta.Share) -> str:
+    """
+    Start virtiofsd for `share` in the background, return its vhost-user socket
+    once it's listening
+    """
+    sock_file = f"{RUN_DIR}/virtiofsd-{share.tag}.sock"
+    pid_file = f"{RUN_DIR}/virtiofsd-{share.tag}.pid"
+    log_file = f"{RUN_DIR}/virtiofsd-{share.tag}.log"
+    # the daemon of the last start holds the socket
+    utils.sh(["pkill", "-F", pid_file], check=False)
+    utils.sh(["rm", "-f", sock_file, pid_file])
+    argv = [
+        find_binary(),
+        f"--socket-path={sock_file}",
+        f"--shared-dir={share.path}",
+        f"--cache={share.cache}",
+        f"--thread-pool-size={thread_pool_size(share)}",
+        "--sandbox=chroot",  # namespaces need CAP_SYS_ADMIN
+        "--announce-submounts",
+    ]
+    if share.readonly:
+        argv.append("--readonly")
+    log.info(f"Running {shlex.join(argv)} ...")
+    # detached, its output would hold the pipe of `sh` open
+    utils.sh(f"{shlex.join(argv)} >{log_file} 2>&1 </dev/null & echo $! >{pid_file}")
+    # virtiofsd serves one front-end and exits once it disconnects, so the socket
+    # must not be connected to before Qemu
+    if not host.current().wait_for_path(sock_file, timeout=START_TIMEOUT):
+        raise EnvironmentError(f"failed to start virtiofsd, see {log_file}")
+    return sock_file
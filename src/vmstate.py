@@ -0,0 +1,136 @@
+import contextlib
+import itertools
+import json
+import logging
+import os
+import shlex
+import time
+
+import pydantic
+
+from . import caps, meta, qmp
+
+log = logging.getLogger(__name__)
+
+STATE_DIR = os.path.join(meta.STORAGE_DIR, "vmstate")
+STATE_FILE = os.path.join(STATE_DIR, "state.bin")
+META_FILE = os.path.join(STATE_DIR, "state.json")
+SAVE_TIMEOUT = 600  # seconds
+# backend only options, they don't change what the guest sees
+BACKEND_OPTS = {"-netdev", "-incoming"}
+
+
+class SavedState(pydantic.BaseModel):
+    qemu_key: str
+    machine_argv: list[str]
+    files: dict[str, tuple[int, int]]  # size and mtime of drive files
+
+
+def _machine_argv(argv: list[str]) -> list[str]:
+    ret, it = [], iter(argv)
+    for arg in it:
+        if arg in BACKEND_OPTS:
+            next(it, None)
+            continue
+        ret.append(arg)
+    return ret
+
+
+def drive_files(argv: list[str]) -> list[str]:
+    """
+    Writable files of '-drive' and '-blockdev' options (disks and OVMF vars)
+    """
+    files = []
+    for opt, value in itertools.pairwise(argv):
+        if opt not in ("-drive", "-blockdev"):
+            continue
+        props = dict(p.split("=", 1) for p in value.split(",") if "=" in p)
+        if props.get("readonly") == "on":
+            continue
+        if opt == "-drive" and "file" in props:
+            files.append(props["file"])
+        elif opt == "-blockdev" and props.get("driver") == "file":
+            files.append(props["filename"])
+    return files
+
+
+def _stat_files(argv: list[str]) -> dict[str, tuple[int, int]]:
+    files = {}
+    for f in drive_files(argv):
+        with contextlib.suppress(OSError):
+            st = os.stat(f)
+            files[f] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def discard():
+    for f in (META_FILE, STATE_FILE, STATE_FILE + ".tmp"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(f)
+
+
+def save(qmp_port: int = meta.VmPort.QMP, timeout: float = SAVE_TIMEOUT):
+    """
+    Pause the guest, migrate its state to a file and quit Qemu, see `commit`
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp_file = STATE_FILE + ".tmp"
+    log.info(f"Saving VM state to {STATE_FILE} ...")
+    with qmp.Qmp(("127.0.0.1", qmp_port)) as q:
+        q.execute("stop")
+        q.execute("migrate", uri=f"exec:cat > {shlex.quote(tmp_file)}")
+        deadline = time.monotonic() + timeout
+        while (status := q.execute("query-migrate").get("status")) != "completed":
+            if status in ("failed", "cancelled") or time.monotonic() > deadline:
+                q.execute("cont")
+                raise qmp.QmpError(f"saving VM state failed ({status})")
+            time.sleep(0.1)
+        with contextlib.suppress(qmp.QmpError):  # may hang up before replying
+            q.execute("quit")
+
+
+def commit(argv: list[str], arch: str):
+    """
+    Keep the state written by `save`, once Qemu has exited and flushed its drives
+    """
+    tmp_file = STATE_FILE + ".tmp"
+    if not os.path.exists(tmp_file):
+        return
+    state = SavedState(
+        qemu_key=caps.host_key(arch) or "",
+        machine_argv=_machine_argv(argv),
+        files=_stat_files(argv),
+    )
+    os.replace(tmp_file, STATE_FILE)
+    with open(META_FILE, "w") as f:
+        f.write(state.model_dump_json(indent=2))
+    log.info(f"VM state is saved to {STATE_FILE}")
+
+
+def load(argv: list[str], arch: str) -> str | None:
+    """
+    Return the '-incoming' uri of the saved state if it matches `argv`, a state is
+    resumed only once
+    """
+    try:
+        with open(META_FILE) as f:
+            state = SavedState.model_validate(json.load(f))
+    except FileNotFoundError:
+        return None
+    except (ValueError, pydantic.ValidationError):
+        log.warning(f"invalid VM state {META_FILE}, discard it")
+        discard()
+        return None
+    reason = None
+    if state.qemu_key != (caps.host_key(arch) or ""):
+        reason = "Qemu binary or host CPU changed"
+    elif state.machine_argv != _machine_argv(argv):
+        reason = "VM config changed"
+    elif state.files != _stat_files(argv):
+        reason = "drive files changed"
+    if reason:
+        log.warning(f"cannot resume the saved VM state: {reason}, discard it")
+        discard()
+        return None
+    os.remove(META_FILE)
+    return f"exec:cat {shlex.quote(STATE_FILE)}"
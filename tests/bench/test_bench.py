@@ -0,0 +1,194 @@
+import contextlib
+import ipaddress
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import main
+from src import host, meta, portfwd, portproxy, qcow2, scan, vm
+
+from ..fakehost import FakeHost
+
+pytestmark = pytest.mark.offline
+
+
+@pytest.fixture
+def fresh_host(fake_host):
+    """
+    Install a new FakeHost, for each round of benchmarks mutating the host
+    """
+    fakes = [fake_host]
+
+    def install(n_ifaces=1) -> FakeHost:
+        fakes[-1].close()
+        fakes.append(FakeHost(n_ifaces))
+        host.set_host(fakes[-1])
+        return fakes[-1]
+
+    yield install
+    fakes[-1].close()
+
+
+def _qemu_opts(n: int) -> list[dict]:
+    opts: list[dict] = []
+    for i in range(n):
+        opts += [
+            {"device": {"virtio-net-pci": {"netdev": f"nic{i}", "mac": "02:00:00"}}},
+            {"netdev": {"tap": {"id": f"nic{i}", "fd": 3 + i, "vhost": "on"}}},
+            {"drive": f"file=/storage/disk{i}.qcow2,if=virtio"},
+            {"enable-kvm": True},
+        ]
+    return opts
+
+
+@pytest.mark.parametrize("n", [4, 64])
+def test_qemu_config_to_args(benchmark, n):
+    opts = _qemu_opts(n)
+    args = benchmark(lambda: meta.QemuConfig(opts).to_args())
+    assert args.count("-netdev") == n
+
+
+@pytest.mark.parametrize("n_ifaces", [1, 4, 16])
+def test_configure_network(benchmark, fresh_host, n_ifaces):
+    def setup():
+        fresh_host(n_ifaces)
+        c = meta.load_config()
+        c.ifaces = [f"eth{i}" for i in range(n_ifaces)]
+
+    gw, iface_map = benchmark.pedantic(vm.configure_network, setup=setup, rounds=20)
+    assert str(gw) == host.current().default_gateway
+    assert len(iface_map) == n_ifaces
+
+
+@pytest.mark.parametrize("mode", list(meta.NetworkMode))
+def test_configure_network_mode(benchmark, fresh_host, mode):
+    def setup():
+        fresh_host()
+        c = meta.load_config()
+        c.enable_macvlan = mode == meta.NetworkMode.MACVLAN
+        c.enable_passt = mode == meta.NetworkMode.PASST
+
+    benchmark.pedantic(vm.configure_network, setup=setup, rounds=20)
+    assert meta.config.network_mode == mode
+
+
+@pytest.mark.parametrize("prefixlen", [16, 8])
+def test_get_unused_ip(benchmark, fake_host, prefixlen):
+    network = ipaddress.IPv4Network(f"10.0.0.0/{prefixlen}")
+    # the top of the network is taken, the scan has to go through 64 windows
+    hosts = scan.iter_hosts(network)
+    fake_host.alive.update(next(hosts) for _ in range(64 * scan.SCAN_CONCURRENCY))
+    ip = benchmark(vm.get_unused_ip, network, "eth0")
+    assert ip == next(hosts)
+
+
+def test_port_forward(benchmark, fake_host):
+    specs = [f"{p}/{proto}" for p in range(10000, 10500) for proto in ("tcp", "udp")]
+
+    def apply():
+        portfwd.apply([portfwd.parse(s) for s in specs], "10.0.0.254")
+
+    benchmark(apply)
+    assert len(fake_host.nat["CVM-PREROUTING"]) == 2 * -(-500 // portfwd.MULTIPORT_MAX)
+
+
+class _Sink(socketserver.BaseRequestHandler):
+    """
+    Count the bytes of a connection and reply with the count
+    """
+
+    def handle(self):
+        buf = bytearray(1 << 16)
+        n = 0
+        while m := self.request.recv_into(buf):
+            n += m
+        self.request.sendall(str(n).encode())
+
+
+THROUGHPUT_SIZE = 64 << 20
+
+
+@pytest.mark.parametrize("path", ["direct", "proxy"])
+def test_forward_throughput(benchmark, path):
+    """
+    Stream through the port proxy, 'direct' is the baseline of the in-kernel path
+    """
+    chunk = b"\0" * (1 << 20)
+
+    def send(port: int) -> int:
+        with socket.create_connection(("127.0.0.1", port)) as s:
+            for _ in range(THROUGHPUT_SIZE // len(chunk)):
+                s.sendall(chunk)
+            s.shutdown(socket.SHUT_WR)
+            return int(s.recv(64))
+
+    with contextlib.ExitStack() as stack:
+        server = stack.enter_context(socketserver.TCPServer(("127.0.0.1", 0), _Sink))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        stack.callback(server.shutdown)
+        port = server.server_address[1]
+        if path == "proxy":
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                fwd = portfwd.parse(f"{s.getsockname()[1]}:{port}")
+            proxy = portproxy.PortProxy([fwd], "127.0.0.1", bind="127.0.0.1")
+            stack.enter_context(proxy)
+            port = fwd.host_ports[0]
+        assert benchmark(send, port) == THROUGHPUT_SIZE
+
+
+QCOW2_BENCH_SIZE = 64 << 30
+QCOW2_BENCH_STEP = (512 << 20) + (64 << 10)  # a new L2 table every request
+
+
+@pytest.mark.skipif(shutil.which("qemu-img") is None, reason="qemu-img not found")
+@pytest.mark.parametrize("cache", ["default", "sized"])
+def test_qcow2_metadata_cache(benchmark, tmp_path, cache):
+    """
+    Reads over a preallocated 64G image, jumping between L2 tables
+    """
+    image = str(tmp_path / "disk.qcow2")
+    subprocess.run(
+        ["qemu-img", "create", "-f", "qcow2", "-o", "preallocation=metadata"]
+        + [image, str(QCOW2_BENCH_SIZE)],
+        check=True,
+        capture_output=True,
+    )
+    opts = f"driver=qcow2,file.filename={image}"
+    if cache == "sized":
+        sizes = qcow2.cache_sizes(qcow2.read_info(image), 32 << 20)
+        opts += "".join(f",{k}={v}" for k, v in sizes.options().items())
+    argv = ["qemu-img", "bench", "--image-opts", opts, "-c", "100000"]
+    argv += ["-d", "32", "-s", "4096", "-S", str(QCOW2_BENCH_STEP), "-n"]
+    benchmark.pedantic(
+        subprocess.run,
+        args=(argv,),
+        kwargs={"check": True, "capture_output": True},
+        rounds=3,
+    )
+
+
+def test_run_dry(benchmark, fresh_host, cli):
+    def setup():
+        fresh_host()
+        meta.load_config()
+
+    ret = benchmark.pedantic(cli, args=(["run", "--dry"],), setup=setup, rounds=20)
+    assert ret.exit_code == 0, ret.output
+    assert "-netdev" in meta.config.qemu_args
+
+
+def test_import_main(benchmark):
+    # a fresh interpreter each round, `import main` runs on every CLI start
+    cmd = [sys.executable, "-c", "import main"]
+    benchmark.pedantic(
+        subprocess.run,
+        args=(cmd,),
+        kwargs={"cwd": main.THIS_DIR, "check": True},
+        rounds=10,
+    )
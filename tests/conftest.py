@@ -8,11 +8,19 @@ import pytest
 import typer.testing
 
 import main
-from src import meta
+from src import backing, caps, host, imagecache, lease, meta, vm
+
+from .fakehost import FakeHost
 
 logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
 
 
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "offline: runs against a FakeHost, no 'container-vm-test' needed"
+    )
+
+
 def pytest_collection_modifyitems(config, items):
     """
     Write test ids to '.pytest-nodeids'
@@ -22,8 +30,10 @@ def pytest_collection_modifyitems(config, items):
         json.dump(nodeids, f)
 
 
-@pytest.fixture(scope="session", autouse=True)
-def check_env():
+@pytest.fixture(autouse=True)
+def check_env(request):
+    if request.node.get_closest_marker("offline"):
+        return
     if os.getenv("CONTAINER_VM_TEST_IN_CONTAINER") != "1":
         raise EnvironmentError("Tests must be run inside 'container-vm-test'")
 
@@ -41,3 +51,28 @@ def c():
 def cli():
     runner = typer.testing.CliRunner()
     return functools.partial(runner.invoke, main.app)
+
+
+@pytest.fixture
+def fake_host(tmp_path, monkeypatch):
+    """
+    Swap the host backend with a FakeHost, keep storage in `tmp_path`
+    """
+    monkeypatch.setattr(meta, "config", meta.config)  # restored after `load_config`
+    monkeypatch.setattr(meta, "STORAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(caps, "CAPS_FILE", str(tmp_path / "caps.json"))
+    monkeypatch.setattr(lease, "LEASE_FILE", str(tmp_path / "leases.json"))
+    monkeypatch.setattr(backing, "BASE_DIR", str(tmp_path / "base"))
+    monkeypatch.setattr(backing, "REFS_FILE", str(tmp_path / "base" / "refs.json"))
+    monkeypatch.setattr(imagecache, "CACHE_DIR", str(tmp_path / "images"))
+    monkeypatch.setattr(
+        imagecache, "INDEX_FILE", str(tmp_path / "images" / "index.json")
+    )
+    monkeypatch.setattr(vm, "VM_ID_FILE", str(tmp_path / "vm-id"))
+    vm.get_vm_id.cache_clear()
+    fake = FakeHost()
+    prev = host.set_host(fake)
+    yield fake
+    host.set_host(prev)
+    fake.close()
+    vm.get_vm_id.cache_clear()
@@ -0,0 +1,335 @@
+import contextlib
+import ipaddress
+import os
+import shlex
+import subprocess
+
+from src import host, netinfo, qcow2
+
+IFF_UP = 0x1
+
+QEMU_MACHINE_HELP = """Supported machines are:
+microvm              microvm (i386)
+pc                   Standard PC (i440FX + PIIX, 1996) (alias of pc-i440fx-8.2)
+pc-i440fx-8.2        Standard PC (i440FX + PIIX, 1996) (default)
+q35                  Standard PC (Q35 + ICH9, 2009) (alias of pc-q35-8.2)
+pc-q35-8.2           Standard PC (Q35 + ICH9, 2009)
+virt                 QEMU 8.2 ARM Virtual Machine (alias of virt-8.2)
+virt-8.2             QEMU 8.2 ARM Virtual Machine
+none                 empty machine
+"""
+QEMU_ACCEL_HELP = """Accelerators supported in QEMU binary:
+tcg
+kvm
+"""
+QEMU_ARCHS = ["x86_64", "aarch64"]
+NAT_BUILTIN_CHAINS = ["PREROUTING", "INPUT", "OUTPUT", "POSTROUTING"]
+FAKE_DEVICES = ["/dev/net/tun", "/dev/vhost-net", "/dev/kvm"]
+
+
+class FakeHost(host.Host):
+    """
+    Simulated host for offline tests and benchmarks.
+
+    It has `n_ifaces` ethernet links 'eth<i>' in 10.<i>.0.0/`prefixlen` behind a
+    default gateway on 'eth0', and applies `ip` (including '-batch') to its link
+    table and `iptables`(-save/-restore) to its nat table. Only addresses in `alive` answer `ping`
+    and probes, every other command succeeds with empty output.
+    """
+
+    def __init__(self, n_ifaces=1, prefixlen=24, alive=()):
+        self.calls: list = []
+        self.files: dict[str, str] = {p: "" for p in FAKE_DEVICES}
+        self.fds: list[int] = []
+        self.links: dict[str, netinfo.Interface] = {}
+        self._add_link("lo", flags=netinfo.IFF_LOOPBACK | IFF_UP)
+        self.links["lo"].ipnets.append("127.0.0.1/8")
+        for i in range(n_ifaces):
+            self._add_link(f"eth{i}", flags=IFF_UP)
+            self.links[f"eth{i}"].ipnets.append(f"10.{i}.0.2/{prefixlen}")
+        self.default_gateway = "10.0.0.1"
+        self.default_interface = "eth0"
+        self.alive = {self.default_gateway, *alive}
+        self.nat: dict[str, list[str]] = {c: [] for c in NAT_BUILTIN_CHAINS}
+
+    def _add_link(self, name: str, flags=0):
+        index = max((i.index for i in self.links.values()), default=0) + 1
+        mac = f"02:00:00:00:{index >> 8:02x}:{index & 0xFF:02x}"
+        self.links[name] = netinfo.Interface(
+            name=name, index=index, mac=mac, flags=flags
+        )
+
+    @property
+    def nat_rules(self) -> list[str]:
+        return [f"-A {c} {r}" for c, rules in self.nat.items() for r in rules]
+
+    def close(self):
+        devnull = os.stat(os.devnull).st_rdev
+        for fd in self.fds:
+            # may be moved by a launch plan or closed already, and the fd reused
+            with contextlib.suppress(OSError):
+                if os.fstat(fd).st_rdev == devnull:
+                    os.close(fd)
+        self.fds.clear()
+
+    #
+    # Host
+    #
+
+    def run(self, args, **kwargs) -> subprocess.CompletedProcess:
+        self.calls.append(args)
+        if isinstance(args, list) and args[:2] == ["bash", "-c"]:
+            argv = shlex.split(args[2])
+        else:
+            argv = [str(a) for a in ([args] if isinstance(args, str) else args)]
+        returncode, stdout, stderr = self._dispatch(argv, kwargs.get("input"))
+        ret = subprocess.CompletedProcess(
+            args, returncode, stdout.encode(), stderr.encode()
+        )
+        if kwargs.get("check"):
+            ret.check_returncode()
+        return ret
+
+    def inventory(self) -> netinfo.Inventory:
+        return netinfo.Inventory(
+            interfaces={
+                name: i.model_copy(deep=True) for name, i in self.links.items()
+            },
+            default_gateway=self.default_gateway,
+            default_interface=self.default_interface,
+            nameservers=[self.default_gateway],
+        )
+
+    def probe(self, ips: list[str], iface: str | None = None) -> set[str]:
+        return self.alive.intersection(ips)
+
+    def qemu_binaries(self) -> dict[str, str]:
+        return {arch: f"/usr/bin/qemu-system-{arch}" for arch in QEMU_ARCHS}
+
+    def exists(self, path: str) -> bool:
+        return path in self.files
+
+    def write_file(self, path: str, content: str):
+        self.files[path] = content
+
+    def mknod(self, path: str, mode: int, major: int, minor: int):
+        if path in self.files:
+            raise FileExistsError(path)
+        self.files[path] = f"{major}:{minor}"
+
+    def remove(self, path: str):
+        if self.files.pop(path, None) is None:
+            raise FileNotFoundError(path)
+
+    def open_device(self, path: str) -> int:
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        fd = os.open(os.devnull, os.O_RDWR)
+        self.fds.append(fd)
+        return fd
+
+    def wait_for_socket(self, addr, timeout: float = 5) -> bool:
+        return True
+
+    def wait_for_path(self, path: str, timeout: float = 5) -> bool:
+        return True
+
+    def char_device(self, netdev: str) -> tuple[int, int]:
+        if netdev not in self.links:
+            raise OSError(f"cannot find char device of {netdev}")
+        return 240, self.links[netdev].index
+
+    #
+    # Commands
+    #
+
+    def _dispatch(self, argv: list[str], input=None) -> tuple[int, str, str]:
+        prog = argv[0] if argv else ""
+        if prog == "ip":
+            if "-batch" in argv:
+                if isinstance(input, bytes):
+                    input = input.decode()
+                return self._ip_batch((input or "").splitlines(), "-force" in argv)
+            return self._ip(argv[1:])
+        if prog == "iptables":
+            return self._iptables(argv[1:])
+        if prog == "iptables-save":
+            return 0, self._iptables_save(), ""
+        if prog == "iptables-restore":
+            if isinstance(input, bytes):
+                input = input.decode()
+            return self._iptables_restore((input or "").splitlines())
+        if prog == "ping":
+            return (0 if argv[-1] in self.alive else 1), "", ""
+        if prog == "capsh":  # `capsh --print | grep '!cap_xxx'` finds nothing
+            return 1, "", ""
+        if prog in ("ionice", "nice"):  # '-c 3', '-n 19'
+            return self._dispatch(argv[3:], input)
+        if prog == "qemu-img":
+            return self._qemu_img(argv[1:])
+        if prog.startswith("qemu-system-"):
+            if "-machine" in argv:
+                out = QEMU_MACHINE_HELP
+            elif "-accel" in argv:
+                out = QEMU_ACCEL_HELP
+            else:
+                out = ""
+            return 0, out, ""
+        return 0, "", ""
+
+    def _qemu_img(self, args: list[str]) -> tuple[int, str, str]:
+        """
+        'create', 'rebase' and 'convert' write a qcow2 header without clusters
+        """
+        opts, files, it = {}, [], iter(args[1:])
+        for a in it:
+            if a in ("-f", "-o", "-b", "-B", "-F", "-O", "-S", "-r"):
+                opts[a] = next(it)
+            elif not a.startswith("-"):
+                files.append(a)
+        if args[0] == "create" and opts.get("-f") == "qcow2":
+            file, size = files[0], files[1] if len(files) > 1 else None
+            backing = opts.get("-b")
+            if size:
+                size = _size(size)
+            elif base := qcow2.read_info(backing):
+                size = base.size
+            else:
+                size = os.path.getsize(backing)
+            o = dict(kv.split("=") for kv in opts.get("-o", "").split(",") if kv)
+            cluster_size = _size(o.get("cluster_size", "64K"))
+            info = qcow2.Info(size, cluster_size, backing_file=backing or None)
+            write_qcow2(file, info._replace(extended_l2=o.get("extended_l2") == "on"))
+        elif args[0] == "convert" and opts.get("-O") == "qcow2":
+            info = qcow2.read_info(files[0])
+            write_qcow2(files[1], info._replace(backing_file=opts.get("-B")))
+        elif args[0] == "rebase":
+            info = qcow2.read_info(files[0])
+            write_qcow2(files[0], info._replace(backing_file=opts["-b"] or None))
+        return 0, "", ""
+
+    def _iptables(self, args: list[str]) -> tuple[int, str, str]:
+        if args[:2] == ["-t", "nat"]:
+            args = args[2:]
+        op, chain, rule = args[0], args[1], " ".join(args[2:])
+        if chain not in self.nat:
+            return 1, "", f"iptables: No chain/target/match by that name ({chain})\n"
+        rules = self.nat[chain]
+        if op == "-A":
+            rules.append(rule)
+        elif op in ("-C", "-D"):
+            if rule not in rules:
+                return 1, "", "iptables: Bad rule (does a matching rule exist?)\n"
+            if op == "-D":
+                rules.remove(rule)
+        return 0, "", ""
+
+    def _iptables_save(self) -> str:
+        lines = ["*nat"]
+        for chain in self.nat:
+            policy = "ACCEPT" if chain in NAT_BUILTIN_CHAINS else "-"
+            lines.append(f":{chain} {policy} [0:0]")
+        lines += self.nat_rules
+        return "\n".join(lines + ["COMMIT", ""])
+
+    def _iptables_restore(self, lines: list[str]) -> tuple[int, str, str]:
+        # --noflush, applied only if every line is valid
+        nat = {c: list(rules) for c, rules in self.nat.items()}
+        for n, line in enumerate(lines, 1):
+            if not line.strip() or line.startswith(("#", "*", "COMMIT")):
+                continue
+            if line.startswith(":"):
+                nat[line[1:].split()[0]] = []
+                continue
+            op, chain, *rule = line.split()
+            if chain not in nat or op not in ("-A", "-F"):
+                return 2, "", f"iptables-restore: line {n} failed\n"
+            if op == "-F":
+                nat[chain].clear()
+            else:
+                nat[chain].append(" ".join(rule))
+        self.nat = nat
+        return 0, "", ""
+
+    def _ip_batch(self, lines: list[str], force: bool) -> tuple[int, str, str]:
+        errors = []
+        for n, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            returncode, _, stderr = self._ip(line.split())
+            if returncode:
+                errors.append(f"{stderr}Command failed -:{n}\n")
+                if not force:
+                    break
+        return (1 if errors else 0), "", "".join(errors)
+
+    def _ip(self, tokens: list[str]) -> tuple[int, str, str]:
+        obj, cmd, args = tokens[0], tokens[1], tokens[2:]
+
+        def after(word):
+            return args[args.index(word) + 1] if word in args else None
+
+        if obj in ("link", "tuntap") and cmd == "add":
+            name = after("name") or after("dev") or args[0]
+            if name in self.links:
+                return 2, "", "RTNETLINK answers: File exists\n"
+            link = after("link")
+            if link and link not in self.links:
+                return 1, "", f'Cannot find device "{link}"\n'
+            self._add_link(name)
+            return 0, "", ""
+        name = after("dev") or (args[0] if obj == "link" else None)
+        if obj == "route":
+            if cmd in ("replace", "add") and "default" in args:
+                gw = ipaddress.IPv4Address(after("via"))
+                for i in self.links.values():
+                    if any(gw in ipaddress.IPv4Interface(n).network for n in i.ipnets):
+                        self.default_gateway, self.default_interface = str(gw), i.name
+                        return 0, "", ""
+                return 2, "", "Error: Nexthop has invalid gateway.\n"
+            return 0, "", ""
+        if name not in self.links:
+            return 1, "", f'Cannot find device "{name}"\n'
+        link = self.links[name]
+        if cmd in ("del", "delete"):
+            del self.links[name]
+        elif obj == "link" and cmd == "set":
+            if "address" in args:
+                link.mac = after("address")
+            if "up" in args:
+                link.flags |= IFF_UP
+            if "master" in args and after("master") not in self.links:
+                return 1, "", f'Cannot find device "{after("master")}"\n'
+        elif obj == "address" and cmd == "add":
+            ipnet = str(ipaddress.IPv4Interface(args[0]))
+            if ipnet in link.ipnets:
+                return 2, "", "RTNETLINK answers: File exists\n"
+            link.ipnets.append(ipnet)
+        elif obj == "address" and cmd == "flush":
+            link.ipnets.clear()
+        return 0, "", ""
+
+
+def _size(s: str) -> int:
+    return int(s) if s.isdigit() else int(s[:-1]) << " KMGT".index(s[-1]) * 10
+
+
+def write_qcow2(file: str, info: qcow2.Info):
+    """
+    A version 3 qcow2 header of `info`, without any cluster
+    """
+    backing = (info.backing_file or "").encode()
+    offset = qcow2.HEADER_V3_OFFSET + qcow2.HEADER_V3.size
+    header = qcow2.HEADER.pack(
+        qcow2.MAGIC,
+        3,
+        offset if backing else 0,
+        len(backing),
+        info.cluster_size.bit_length() - 1,
+        info.size,
+    ).ljust(qcow2.HEADER_V3_OFFSET, b"\0")
+    incompatible = qcow2.EXTENDED_L2 if info.extended_l2 else 0
+    refcount_order = info.refcount_bits.bit_length() - 1
+    header += qcow2.HEADER_V3.pack(incompatible, 0, 0, refcount_order, offset)
+    with open(file, "wb") as f:
+        f.write(header + backing)
@@ -1,6 +1,46 @@
+import asyncio
+import contextlib
+import hashlib
+import http.server
 import ipaddress
+import json
+import logging
+import os
+import pathlib
+import shlex
+import signal
+import socket
+import socketserver
+import subprocess
+import threading
+import time
 
-from src import meta, utils, vm
+import click
+import pytest
+
+from src import (
+    caps,
+    compact,
+    dhcp,
+    host,
+    imagecache,
+    lease,
+    meta,
+    netbatch,
+    passt,
+    pipeline,
+    portfwd,
+    portproxy,
+    qcow2,
+    scan,
+    service,
+    trace,
+    utils,
+    vm,
+    vmstate,
+)
+
+from .fakehost import write_qcow2
 
 
 def test_get_vm_interfaces():
@@ -53,3 +93,700 @@ def test_configure_network():
 def test_configure_network_with_tap_mode(c):
     c.enable_macvlan = False
     vm.configure_network()
+
+
+def test_get_unused_ip():
+    iface = utils.get_default_interface()
+    ipnets, _ = utils.get_interface_info(iface)
+    ip = ipnets[0].split("/")[0]
+    network = ipaddress.IPv4Network(ipnets[0], strict=False)
+    gw = utils.get_default_route()
+
+    new_ip = vm.get_unused_ip(network, iface, exclude=[ip])
+    assert new_ip
+    assert new_ip not in (ip, gw)
+    assert ipaddress.ip_address(new_ip) in network
+
+
+def test_netbatch_rollback():
+    dev_name, _ = vm._gen_netdev_name(meta.NetworkMode.TAP_BRIDGE)
+    with pytest.raises(OSError), netbatch.transaction() as batch:
+        batch.add(
+            f"link add dev {dev_name} type bridge", undo=f"link del dev {dev_name}"
+        )
+        batch.flush()
+        assert dev_name in utils.list_interfaces()
+        batch.add("link set dev not-exists up")
+    assert dev_name not in utils.list_interfaces()
+
+
+@pytest.mark.offline
+def test_qemu_config_to_argv():
+    tap = {"tap": {"id": "nic0", meta.QemuOptKDict.RAW_KEY: "vhost=on"}}
+    qemu = meta.QemuConfig([{"enable-kvm": True}, {"netdev": tap}, {"m": 1024}])
+    argv = ["-enable-kvm", "-netdev", "tap,id=nic0,vhost=on", "-m", "1024"]
+    assert qemu.to_argv() == argv
+    assert qemu.to_argv() == argv  # rendering is repeatable
+    assert meta.QemuOptKDict.RAW_KEY in tap["tap"]  # input is not mutated
+    qemu.insert(0, {"cdrom": "/storage/a.iso"})
+    assert qemu.to_argv()[:2] == ["-cdrom", "/storage/a.iso"]
+    with pytest.raises(TypeError):
+        qemu.append({"smp": [1, 2]})
+
+
+@pytest.mark.offline
+def test_caps_cache(fake_host, monkeypatch):
+    monkeypatch.setattr(caps, "host_key", lambda arch: f"/usr/bin/qemu-{arch}:1:2:f")
+    for _ in range(2):
+        assert caps.get_qemu_accels("x86_64") == ["tcg", "kvm"]
+        assert "q35" in caps.get_qemu_machines("x86_64", active_only=True)
+        assert caps.is_io_uring_supported("x86_64")
+    assert len(fake_host.calls) == 3  # probed once
+    cached = json.loads(pathlib.Path(caps.CAPS_FILE).read_text())
+    assert cached["/usr/bin/qemu-x86_64:1:2:f"]["accels"] == ["tcg", "kvm"]
+    assert cached["/usr/bin/qemu-x86_64:1:2:f"]["io_uring"] is True
+
+
+@pytest.mark.offline
+def test_pipeline_qemu_opts_order(c):
+    def slow_stage(_):
+        time.sleep(0.1)
+        c.qemu.append({"name": "slow"})
+        return "slow"
+
+    results = pipeline.run(
+        [
+            pipeline.Stage("first", lambda: None),
+            pipeline.Stage("slow", slow_stage, ("first",)),
+            pipeline.Stage("fast", lambda _: c.qemu.append({"m": 64}), ("first",)),
+            pipeline.Stage("after", lambda v: v + "!", ("slow",)),
+        ]
+    )
+    assert results["after"] == "slow!"
+    argv = c.qemu.to_argv()
+    assert argv.index("-name") < argv.index("-m")  # stage order, not finish order
+
+
+@pytest.mark.offline
+def test_pipeline_error():
+    ran = []
+
+    def fail(_):
+        raise subprocess.CalledProcessError(1, ["ip"])
+
+    with pytest.raises(subprocess.CalledProcessError):
+        pipeline.run(
+            [
+                pipeline.Stage("first", lambda: None),
+                pipeline.Stage("fail", fail, ("first",)),
+                pipeline.Stage("slow", lambda _: time.sleep(0.1), ("first",)),
+                pipeline.Stage("after", lambda _: ran.append("after"), ("fail",)),
+            ]
+        )
+    assert not ran
+
+
+@pytest.mark.offline
+def test_trace(fake_host, tmp_path, monkeypatch, caplog):
+    class Ping:
+        async def wait(self):
+            return 0
+
+    async def create_subprocess_exec(*args, **kwargs):
+        return Ping()
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", create_subprocess_exec)
+    utils.sh(["iptables-save"])
+    assert trace.summary() == []  # only collected with '--profile'
+
+    trace.enable()
+    try:
+        with trace.phase("network"):
+            utils.sh(["iptables-save"])
+            assert scan.ping_scan(["10.0.0.1", "10.0.0.2"]) == {"10.0.0.1", "10.0.0.2"}
+        with trace.phase("disk"):
+            utils.sh(f"qemu-img create -f qcow2 {tmp_path / 'x.qcow2'} 1G", check=False)
+        utils.sh(["true"])
+        rows = {r["phase"]: r for r in trace.summary()}
+        assert rows.keys() == {"network", "disk", "main"}
+        assert rows["network"]["subprocs"] == 3
+        assert rows["disk"]["subprocs"] == 1 and rows["disk"]["wall"] > 0
+        assert rows["main"]["subprocs"] == 1 and rows["main"]["wall"] == 0
+
+        with caplog.at_level(logging.INFO):
+            trace.log_summary()
+        assert "network" in caplog.text and "disk" in caplog.text
+
+        trace.dump_chrome_trace(str(tmp_path / "trace.json"))
+        events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+        assert [e["name"] for e in events if e["cat"] == "phase"] == ["network", "disk"]
+        pings = [e for e in events if e["name"] == "ping"]
+        assert len(pings) == 2 and all(e["ph"] == "X" for e in events)
+        assert pings[0]["args"]["phase"] == "network"
+    finally:
+        trace.enable(False)
+    assert trace.summary() == []
+
+
+@pytest.mark.offline
+def test_replay_host(tmp_path):
+    recorder = host.RecordingHost()
+    prev = host.set_host(recorder)
+    try:
+        assert utils.sh(["echo", "hello"]).stdout == b"hello\n"
+        assert utils.sh("exit 3", check=False).returncode == 3
+    finally:
+        host.set_host(prev)
+    recorder.save(str(tmp_path / "records.json"))
+
+    prev = host.set_host(host.ReplayHost(str(tmp_path / "records.json")))
+    try:
+        assert utils.sh(["echo", "hello"]).stdout == b"hello\n"
+        with pytest.raises(subprocess.CalledProcessError):
+            utils.sh("exit 3")
+        with pytest.raises(OSError):
+            utils.sh(["echo", "not recorded"])
+    finally:
+        host.set_host(prev)
+
+
+@pytest.mark.offline
+def test_wait_for_path(tmp_path):
+    sock_file = str(tmp_path / "daemon.sock")
+    h = host.Host()
+    assert not h.wait_for_path(sock_file, timeout=0.05)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(sock_file)
+        server.listen()
+        server.setblocking(False)
+        assert h.wait_for_path(sock_file, timeout=0.05)
+        with pytest.raises(BlockingIOError):  # nothing connected
+            server.accept()
+
+
+@pytest.mark.offline
+def test_vhost_permitted(fake_host, monkeypatch):
+    assert vm._is_vhost_permitted()
+    del fake_host.files["/dev/vhost-net"]
+    assert vm._is_vhost_permitted()  # probed on a temporary node
+    assert "/dev/tmp-vhost-net" not in fake_host.files
+
+    def denied(path):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(fake_host, "open_device", denied)
+    assert not vm._is_vhost_permitted()
+    assert "/dev/tmp-vhost-net" not in fake_host.files
+    assert fake_host.calls == []  # no shell
+
+
+@pytest.mark.offline
+def test_warm_restart(fake_host, c):
+    c.port_forwards = ["2222:22"]
+    gw, iface_map = vm.configure_network()
+    vm.configure_port_forward(gw, iface_map)
+    links, rules = set(fake_host.links), list(fake_host.nat_rules)
+    assert fake_host.default_interface == "macvlan0"  # the route moved off eth0
+    fake_host.calls.clear()
+
+    c.qemu.clear()
+    assert vm.configure_network() == (gw, iface_map)
+    vm.configure_port_forward(gw, iface_map)
+    assert set(fake_host.links) == links
+    assert fake_host.nat_rules == rules
+    assert "-netdev" in c.qemu_args
+
+
+@pytest.mark.offline
+def test_lease(fake_host, c):
+    mode, ipnet = meta.NetworkMode.TAP_BRIDGE, "10.0.0.2/24"
+    mac, ipnet_vm = vm.setup_bridge("eth0", mode, ipnet)
+    ip = ipnet_vm.split("/")[0]
+    last = lease.get(vm.get_vm_id(), "eth0", 0)
+    assert (last.mac, last.ip, last.mode) == (mac, ip, mode)
+
+    # the devices and the address are reused
+    fake_host.calls.clear()
+    assert vm.setup_bridge("eth0", mode, ipnet) == (mac, ipnet_vm)
+    assert not any(a[:2] == ["ip", "-batch"] for a in fake_host.calls)
+
+    # the address is revalidated, it's taken by another host now
+    fake_host.alive.add(ip)
+    new_mac, new_ipnet_vm = vm.setup_bridge("eth0", mode, ipnet)
+    assert new_mac == mac and new_ipnet_vm != ipnet_vm
+
+    # leases of another network or of the host address are rejected
+    for stale_ip in ["192.168.1.10", "10.0.0.2"]:
+        stale = lease.Lease(mac=mac, ip=stale_ip, mode=mode, dev_id="deadbeef")
+        lease.put(vm.get_vm_id(), "eth0", 0, stale)
+        _, ipnet_vm = vm.setup_bridge("eth0", mode, ipnet)
+        assert ipnet_vm.split("/")[0] not in (stale_ip, ip)
+        assert lease.get(vm.get_vm_id(), "eth0", 0).dev_id != "deadbeef"
+
+
+@pytest.mark.offline
+def test_lease_concurrent_put(fake_host):
+    def put(i):
+        lease.put("vm", f"eth{i}", 0, lease.Lease(mac=f"02:00:00:00:00:{i:02x}"))
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(32)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(lease.get_all("vm")) == 32
+
+
+@pytest.mark.offline
+def test_multiqueue(fake_host, c):
+    c.enable_macvlan, c.cpu_num = False, 4
+    vm.configure_network()
+    assert lease.get_all(vm.get_vm_id())["eth0"].queues == 4
+    assert "queues=4,vhost=on" in c.qemu_args
+    assert "mq=on,vectors=10" in c.qemu_args
+    links = set(fake_host.links)
+
+    # the single queue tap of the last start is not reused
+    c.qemu.clear()
+    c.net_queues = 1
+    vm.configure_network()
+    assert set(fake_host.links) != links
+    assert "queues=" not in c.qemu_args and "mq=on" not in c.qemu_args
+
+    c.qemu.clear()
+    c.qemu.pass_fds.clear()
+    c.enable_macvlan, c.net_queues = True, 2
+    vm.configure_network()
+    assert len(c.qemu.pass_fds) == 4
+    fds = [str(fd) for fd in c.qemu.pass_fds]
+    assert f"fds={fds[0]}:{fds[1]},vhostfds={fds[2]}:{fds[3]}" in c.qemu_args
+
+
+@pytest.mark.offline
+def test_io_profile(c, monkeypatch):
+    c.cpu_num = 4
+    monkeypatch.setattr(caps, "is_io_uring_supported", lambda _: True)
+    vm.configure_drive("data 1", "/data/data.qcow2", "qcow2", meta.IoProfile.LATENCY)
+    args = c.qemu_args
+    assert "iothread,id=io-data_1,poll-max-ns=262144" in args
+    file_node = "driver=file,node-name=file-data_1,filename=/data/data.qcow2"
+    assert f"{file_node},aio=io_uring,cache.direct=on,discard=unmap" in args
+    assert "driver=qcow2,node-name=disk-data_1,file=file-data_1" in args
+    assert "virtio-blk-pci,drive=disk-data_1,iothread=io-data_1,num-queues=4" in args
+    assert vmstate.drive_files(shlex.split(args)) == ["/data/data.qcow2"]
+
+    c.qemu.clear()
+    monkeypatch.setattr(caps, "is_io_uring_supported", lambda _: False)
+    vm.configure_drive("data", "/data/data.raw", "raw", meta.IoProfile.SAFE)
+    assert "aio=native" in c.qemu_args and "write-cache=off" in c.qemu_args
+
+
+@pytest.mark.offline
+def test_qcow2_cache_sizes(tmp_path):
+    image = tmp_path / "disk.qcow2"
+    header = qcow2.HEADER.pack(qcow2.MAGIC, 3, 0, 0, 16, 64 << 30)
+    header = header.ljust(qcow2.HEADER_V3_OFFSET, b"\0")
+    header += qcow2.HEADER_V3.pack(0, 0, 0, 4, 104)
+    image.write_bytes(header)
+    info = qcow2.read_info(str(image))
+    assert info == qcow2.Info(64 << 30, 64 << 10, refcount_bits=16)
+    assert qcow2.read_info(str(tmp_path / "missing")) is None
+
+    # the L2 tables of 64G in 64K clusters take 8M, its refcount blocks 2M
+    assert qcow2.cache_sizes(info, 32 << 20) == (8 << 20, 2 << 20)
+    assert qcow2.cache_sizes(info, 5 << 20) == (4 << 20, 1 << 20)
+    assert qcow2.cache_sizes(info, 0) == (128 << 10, 256 << 10)  # Qemu's minimum
+    # subclusters double the L2 entries
+    assert qcow2.cache_sizes(info._replace(extended_l2=True), 32 << 20).l2 == 16 << 20
+
+
+@pytest.mark.offline
+def test_passt_network(fake_host, c, monkeypatch):
+    c.enable_passt = True
+    c.port_forwards = ["2222:22", "53/udp", "5900-5910"]
+    gw, iface_map = vm.configure_network()
+    _, ipnet = iface_map["eth0"]
+    assert ipnet == "10.0.0.2/24"  # the guest takes the address of the iface
+    assert set(fake_host.links) == {"lo", "eth0"}
+    argv = next(a for a in fake_host.calls if a[0] == "passt")
+    assert argv[-6:] == ["-t", "2222:22", "-u", "53", "-t", "5900-5910"]
+    assert "stream,id=nic0,server=off,addr.type=unix" in c.qemu_args
+    assert vm.configure_port_forward(gw, iface_map) is None
+    assert vm.configure_dhcp(gw, iface_map) is None
+
+    # without NET_ADMIN, passt is used if it's installed
+    c.enable_passt = False
+    monkeypatch.setattr(utils, "check_linux_capability", lambda _: False)
+    vm.check_capabilities()
+    assert c.network_mode == meta.NetworkMode.PASST
+    c.enable_passt = False
+    monkeypatch.setattr(passt, "is_available", lambda: False)
+    with pytest.raises(click.UsageError):
+        vm.check_capabilities()
+
+
+@pytest.mark.offline
+def test_vmstate_validation(tmp_path, monkeypatch):
+    monkeypatch.setattr(vmstate, "STATE_FILE", str(tmp_path / "state.bin"))
+    monkeypatch.setattr(vmstate, "META_FILE", str(tmp_path / "state.json"))
+    disk = tmp_path / "disk.qcow2"
+    disk.write_bytes(b"disk")
+    argv = ["qemu-system-x86_64", "-m", "1024", "-drive", f"file={disk},if=virtio"]
+    argv += ["-netdev", "tap,id=nic0,fd=3"]
+
+    def save_and_commit(argv):
+        (tmp_path / "state.bin.tmp").write_bytes(b"state")
+        vmstate.commit(argv, "x86_64")
+
+    save_and_commit(argv)
+    # backend options (e.g. fds) may differ between runs
+    argv2 = argv[:-1] + ["tap,id=nic0,fd=4"]
+    assert vmstate.load(argv2, "x86_64").startswith("exec:cat ")
+    assert vmstate.load(argv2, "x86_64") is None  # resumed only once
+
+    save_and_commit(argv)
+    assert vmstate.load(argv + ["-smp", "2"], "x86_64") is None
+    assert not (tmp_path / "state.bin").exists()
+
+    save_and_commit(argv)
+    disk.write_bytes(b"changed disk")
+    assert vmstate.load(argv, "x86_64") is None
+
+
+@pytest.mark.offline
+def test_port_forward_rules():
+    specs = ["22", "80:8080", "53/udp", "5900-5910", "60000-60010/udp"]
+    specs += [str(p) for p in range(1000, 1020)]
+    rules = portfwd.build_rules([portfwd.parse(s) for s in specs], "10.0.0.2")
+    assert any(
+        "-p udp -m multiport --dports 53,60000:60010 -j DNAT" in r for r in rules
+    )
+    assert any("--dport 80 -j DNAT --to-destination 10.0.0.2:8080" in r for r in rules)
+    assert any("-p tcp --dport 8080 -j MASQUERADE" in r for r in rules)
+    for r in rules:
+        if "--dports" in r:
+            ports = r.split("--dports ")[1].split()[0].split(",")
+            assert sum(2 if ":" in p else 1 for p in ports) <= portfwd.MULTIPORT_MAX
+    with pytest.raises(ValueError):
+        portfwd.parse("1000-1010:2000-2010")
+    with pytest.raises(ValueError):
+        portfwd.parse("80/sctp")
+
+
+def _free_port(kind=socket.SOCK_STREAM) -> int:
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _echo_server(kind):
+    tcp = kind == socket.SOCK_STREAM
+
+    class Echo(socketserver.BaseRequestHandler):
+        def handle(self):
+            if tcp:
+                while data := self.request.recv(65536):
+                    self.request.sendall(data)
+            else:
+                data, sock = self.request
+                sock.sendto(data, self.client_address)
+
+    server_cls = socketserver.ThreadingTCPServer if tcp else socketserver.UDPServer
+    with server_cls(("127.0.0.1", 0), Echo) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield server.server_address[1]
+        server.shutdown()
+
+
+@pytest.mark.offline
+def test_port_proxy(c, monkeypatch):
+    tcp_port, udp_port = _free_port(), _free_port(socket.SOCK_DGRAM)
+    stack = contextlib.ExitStack()
+    tcp_echo = stack.enter_context(_echo_server(socket.SOCK_STREAM))
+    udp_echo = stack.enter_context(_echo_server(socket.SOCK_DGRAM))
+    c.port_forwards = [f"{tcp_port}:{tcp_echo}", f"{udp_port}:{udp_echo}/udp"]
+
+    def no_nat(*_):
+        raise subprocess.CalledProcessError(4, ["iptables-restore"])
+
+    monkeypatch.setattr(portfwd, "apply", no_nat)
+    gw = ipaddress.ip_address("127.0.0.1")
+    proxy = vm.configure_port_forward(gw, {"lo": ("", "127.0.0.1/8")})
+    proxy.start()
+    try:
+        payload = bytes(range(256)) * 4096
+        with socket.create_connection(("127.0.0.1", tcp_port)) as s:
+            s.sendall(payload)
+            s.shutdown(socket.SHUT_WR)
+            assert b"".join(iter(lambda: s.recv(65536), b"")) == payload
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(5)
+            s.sendto(b"ping", ("127.0.0.1", udp_port))
+            assert s.recv(64) == b"ping"
+    finally:
+        proxy.stop()
+        stack.close()
+    assert proxy.stats.connections == 1 and proxy.stats.active == 0
+    assert proxy.stats.bytes_in == len(payload) + 4
+    assert proxy.stats.bytes_out == len(payload) + 4
+    assert proxy.stats.flows == 1
+
+    c.port_proxy = False
+    with pytest.raises(subprocess.CalledProcessError):
+        vm.configure_port_forward(gw, {"lo": ("", "127.0.0.1/8")})
+
+
+@pytest.mark.offline
+def test_detached_service(c, monkeypatch):
+    port = _free_port()
+    with _echo_server(socket.SOCK_STREAM) as echo:
+        monkeypatch.setattr(c, "port_forwards", [f"{port}:{echo}"])
+        monkeypatch.setattr(c, "port_proxy", True)
+        gw = ipaddress.ip_address("127.0.0.1")
+        proxy = vm.configure_port_forward(gw, {"lo": ("", "127.0.0.1/8")})
+        pid = service.detach([proxy])
+        try:
+            assert proxy._thread is None  # served by the child only
+            with socket.create_connection(("127.0.0.1", port)) as s:
+                s.sendall(b"ping")
+                s.shutdown(socket.SHUT_WR)
+                assert s.recv(64) == b"ping"
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            assert os.waitpid(pid, 0)[1] == 0
+
+        # setup errors are raised in the parent
+        with socket.socket() as taken:
+            taken.bind(("127.0.0.1", port))
+            proxy = vm.configure_port_forward(gw, {"lo": ("", "127.0.0.1/8")})
+            with pytest.raises(OSError, match="failed to start services"):
+                service.detach([proxy])
+            with pytest.raises(OSError):
+                proxy.start()
+
+
+@pytest.mark.offline
+def test_port_proxy_limits():
+    with _echo_server(socket.SOCK_STREAM) as echo:
+        fwd = portfwd.parse(f"{_free_port()}:{echo}")
+        addr = ("127.0.0.1", fwd.host_ports[0])
+        with portproxy.PortProxy([fwd], "127.0.0.1", max_connections=1) as proxy:
+            s1, s2 = socket.create_connection(addr), socket.create_connection(addr)
+            with s1, s2:
+                s1.sendall(b"hello")
+                assert s1.recv(64) == b"hello"
+                s2.settimeout(5)
+                assert s2.recv(64) == b""  # closed on accept
+        assert proxy.stats.rejected == 1
+
+
+def _dhcp_request(mac: str, msg_type: int, **options: bytes) -> bytes:
+    chaddr = bytes.fromhex(mac.replace(":", "")).ljust(16, b"\0")
+    zero = bytes(4)
+    header = dhcp.HEADER.pack(
+        *(1, 1, 6, 0, 0x1234, 0, 0x8000),
+        *(zero, zero, zero, zero, chaddr),
+        *(bytes(64), bytes(128), dhcp.MAGIC_COOKIE),
+    )
+    opts = {dhcp.Opt.MSG_TYPE: bytes([msg_type])}
+    opts |= {getattr(dhcp.Opt, k.upper()): v for k, v in options.items()}
+    body = b"".join(bytes([k, len(v)]) + v for k, v in opts.items())
+    return header + body + b"\xff"
+
+
+@pytest.mark.offline
+def test_dhcp(c, fake_host):
+    mac = "02:AA:BB:CC:DD:EE"
+    gw, ip = ipaddress.ip_address("10.0.0.1"), "10.0.0.7"
+    server = vm.configure_dhcp(gw, {"eth0": (mac, f"{ip}/24"), "eth1": ("", None)})
+    b = server.bindings[mac]
+    assert b.router == gw and str(b.network) == "10.0.0.0/24"
+    assert service.from_spec(server.spec()).bindings == server.bindings
+
+    server_ip = ipaddress.ip_address("10.0.0.2")
+    msg = dhcp.parse(_dhcp_request(mac.lower(), dhcp.MsgType.DISCOVER))
+    assert msg.mac == mac and msg.xid == 0x1234
+    assert dhcp.reply_type(msg, b, server_ip) == dhcp.MsgType.OFFER
+    offer = dhcp.build_reply(msg, dhcp.MsgType.OFFER, server_ip, b)
+    assert len(offer) >= dhcp.MIN_SIZE
+    fields = dhcp.HEADER.unpack_from(offer)
+    assert fields[0] == 2 and fields[8] == ipaddress.ip_address(ip).packed
+
+    def reply(**options):
+        msg = dhcp.parse(_dhcp_request(mac, dhcp.MsgType.REQUEST, **options))
+        return dhcp.reply_type(msg, b, server_ip)
+
+    assert reply(requested_ip=b.ip.packed) == dhcp.MsgType.ACK
+    assert reply(requested_ip=bytes([10, 0, 0, 9])) == dhcp.MsgType.NAK
+    assert reply(server_id=bytes([10, 0, 0, 3])) is None  # another server's offer
+
+
+@contextlib.contextmanager
+def _image_server(images: dict[str, bytes], ranges=True):
+    """
+    Serve `images` by path, with HTTP range requests if `ranges`, and record the
+    requests
+    """
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            self._send(head=True)
+
+        def do_GET(self):
+            self._send()
+
+        def _send(self, head=False):
+            requests.append((self.command, self.path, self.headers.get("Range")))
+            data = images.get(self.path)
+            if data is None:
+                self.send_error(404)
+                return
+            start, end = 0, len(data)
+            spec = self.headers.get("Range")
+            if ranges and spec and not head:
+                first, last = spec.removeprefix("bytes=").split("-")
+                start, end = int(first), int(last) + 1
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{end - 1}/{len(data)}"
+                )
+            else:
+                self.send_response(200)
+            if ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start))
+            self.end_headers()
+            if not head:
+                self.wfile.write(data[start:end])
+
+        def log_message(self, *_):
+            pass
+
+    with http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield f"http://127.0.0.1:{server.server_address[1]}", requests
+        server.shutdown()
+
+
+@pytest.mark.offline
+def test_image_cache(fake_host, monkeypatch):
+    monkeypatch.setattr(imagecache, "MIN_PART_SIZE", 1 << 20)
+    iso = bytes(range(256)) * (4 << 12)  # 4M
+    other = b"other" * 1000
+    digest = hashlib.sha256(iso).hexdigest()
+    images = {"/a.iso": iso, "/mirror/a.iso": iso, "/b.iso": other}
+    with _image_server(images) as (url, requests):
+        file = imagecache.fetch(f"{url}/a.iso#sha256={digest}")
+        assert pathlib.Path(file).read_bytes() == iso
+        assert sorted(r[2] for r in requests if r[2]) == [
+            "bytes=0-1048575",
+            "bytes=1048576-2097151",
+            "bytes=2097152-3145727",
+            "bytes=3145728-4194303",
+        ]
+
+        # fetched once, and found by its checksum under another url
+        requests.clear()
+        assert imagecache.fetch(f"{url}/a.iso") == file
+        assert imagecache.fetch(f"{url}/mirror/a.iso#sha256={digest}") == file
+        assert not requests
+
+        with pytest.raises(EnvironmentError):
+            imagecache.fetch(f"{url}/b.iso#sha256={'0' * 64}")
+        assert imagecache.lookup(f"{url}/b.iso") is None
+
+        # the least recently used image is evicted over the size cap
+        other_file = imagecache.fetch(f"{url}/b.iso", max_size=len(other))
+        assert imagecache.lookup(f"{url}/a.iso") is None
+        assert not os.path.exists(file)
+        assert imagecache.lookup(f"{url}/b.iso") == other_file
+
+    with _image_server(images, ranges=False) as (url, requests):
+        assert pathlib.Path(imagecache.fetch(f"{url}/a.iso")).read_bytes() == iso
+        assert [r[0] for r in requests] == ["HEAD", "GET"]
+
+
+@pytest.mark.offline
+def test_iso_url(fake_host, c, monkeypatch):
+    with _image_server({"/x.iso": b"iso"}) as (url, _):
+        c.iso = f"{url}/x.iso"
+        c.dry_run = True
+        vm.configure_images()
+        assert c.iso == f"{url}/x.iso"  # not downloaded by a dry run
+        c.dry_run = False
+        vm.configure_images()
+        assert c.iso.startswith(imagecache.CACHE_DIR)
+
+
+@contextlib.contextmanager
+def _json_server(reply, greeting=None, unix_path=None):
+    """
+    A QMP-like server answering each JSON line with `reply(msg)`
+    """
+    requests = []
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            if greeting:
+                self.wfile.write(json.dumps(greeting).encode() + b"\n")
+            for line in self.rfile:
+                requests.append(msg := json.loads(line))
+                self.wfile.write(json.dumps({"return": reply(msg)}).encode() + b"\n")
+
+    if unix_path:
+        server = socketserver.ThreadingUnixStreamServer(unix_path, Handler)
+    else:
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    with server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield unix_path or server.server_address[1], requests
+        server.shutdown()
+
+
+@pytest.mark.offline
+def test_compact_disk(fake_host, tmp_path, monkeypatch):
+    disk = str(tmp_path / "disk.qcow2")
+    write_qcow2(disk, qcow2.Info(16 << 30, 64 << 10))
+    with open(disk, "ab") as f:
+        f.write(os.urandom(1 << 20))  # clusters freed in the guest
+
+    # the VM isn't running, the image is rewritten
+    assert compact.compact(disk, qmp_port=_free_port()) >= 1 << 20
+    argv = next(a for a in fake_host.calls if "convert" in a)
+    assert argv[:6] == ["ionice", "-c", "3", "nice", "-n", "19"]
+    assert "-S" in argv[6:] and "-c" not in argv[6:]  # not compressed
+    assert not os.path.exists(disk + ".compact")
+
+    # the VM is running, the guest trims its filesystems
+    def qmp_reply(msg):
+        if msg["execute"] == "query-block":
+            return [{"device": "virtio0", "inserted": {"image": {"filename": disk}}}]
+        if msg["execute"] == "query-blockstats":
+            return [{"stats": {"rd_operations": 1, "wr_operations": 1}}]
+        return {}
+
+    def agent_reply(msg):
+        if msg["execute"] == "guest-sync":
+            return msg["arguments"]["id"]
+        return {"paths": [{"path": "/", "minimum": msg["arguments"]["minimum"]}]}
+
+    fake_host.calls.clear()
+    with contextlib.ExitStack() as stack:
+        port, _ = stack.enter_context(_json_server(qmp_reply, greeting={"QMP": {}}))
+        agent, requests = stack.enter_context(
+            _json_server(agent_reply, unix_path=str(tmp_path / "qga.sock"))
+        )
+        assert compact.compact(disk, qmp_port=port, agent=agent) == 0
+        assert [r["execute"] for r in requests] == ["guest-sync", "guest-fstrim"]
+        assert not fake_host.calls
+
+        # in the background while the disks are idle
+        monkeypatch.setattr(compact, "IDLE_WINDOW", 0)
+        requests.clear()
+        with compact.Compactor([disk], 0.01, qmp_port=port, agent=agent):
+            deadline = time.monotonic() + 5
+            while len(requests) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        assert requests[1]["execute"] == "guest-fstrim"
@@ -1,4 +1,16 @@
-from src import meta, utils
+import copy
+import json
+import logging
+import os
+import pathlib
+import sys
+
+import click
+import pytest
+
+from src import backing, host, meta, qcow2, service, utils
+
+from .fakehost import FakeHost, write_qcow2
 
 
 def test_help(cli):
@@ -75,3 +87,156 @@ def test_windows(cli, c):
     args = c.qemu_args
     assert c.boot_mode == meta.BootMode.WINDOWS
     assert "windows" in args
+
+
+@pytest.mark.offline
+def test_launch_plan(cli, fake_host, tmp_path, monkeypatch, caplog):
+    args = ["run", "--dry", f"--plan={tmp_path / 'plan.json'}"]
+    monkeypatch.setattr(sys, "argv", ["container-vm", *args])
+    assert cli(args).exit_code == 0
+    links, rules = set(fake_host.links), fake_host.nat_rules
+    fake_host.close()
+    services = json.loads((tmp_path / "plan.json").read_text())["services"]
+    assert [s["name"] for s in services] == ["dhcp"]
+
+    # a new container on the same network executes the plan
+    new_host = FakeHost()
+    host.set_host(new_host)
+    with caplog.at_level(logging.INFO):
+        assert cli(args).exit_code == 0
+    new_host.close()
+    assert "Executing launch plan" in caplog.text
+    assert set(new_host.links) == links
+    assert new_host.nat_rules == rules
+
+    # the network has changed since the plan
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        assert cli(args).exit_code == 0
+    new_host.close()
+    assert "Executing launch plan" not in caplog.text
+
+
+@pytest.mark.offline
+def test_launch_plan_replay(cli, fake_host, tmp_path, monkeypatch, caplog):
+    args = ["run", "--dry", "--macvlan", f"--plan={tmp_path / 'plan.json'}"]
+    monkeypatch.setattr(sys, "argv", ["container-vm", *args])
+    assert cli(args).exit_code == 0
+    fake_host.close()
+    ops = json.loads((tmp_path / "plan.json").read_text())["ops"]
+    recorded = json.dumps(ops)
+    for probe in ["capsh", "iptables-save", "tmp-vhost-net", "-machine"]:
+        assert probe not in recorded
+    assert "port_forward" in [op["op"] for op in ops]
+
+    # executed twice, the second time with the device files and NAT rules left
+    # by the first (e.g. a restarted container)
+    first = FakeHost()
+    host.set_host(first)
+    assert cli(args).exit_code == 0
+    first.close()
+    second = FakeHost()
+    second.files, second.nat = dict(first.files), copy.deepcopy(first.nat)
+    host.set_host(second)
+    with caplog.at_level(logging.INFO):
+        assert cli(args).exit_code == 0, caplog.text
+    second.close()
+    assert "Executing launch plan" in caplog.text
+    assert second.nat_rules == first.nat_rules
+    assert second.files == first.files
+
+
+@pytest.mark.offline
+def test_apply_disk(cli, fake_host, tmp_path):
+    args = ["run", "--dry", "apply-disk", "-n", "data", "--cluster-size=2M"]
+    args += ["--preallocation=metadata", "--lazy-refcounts"]
+    assert cli(args).exit_code == 0
+    create = next(a for a in fake_host.calls if "qemu-img create" in str(a))
+    assert "-o cluster_size=2M,preallocation=metadata,lazy_refcounts=on" in create[2]
+
+    # an existing qcow2 disk gets metadata caches of its own size
+    disk = pathlib.Path(create[2].split()[-2])
+    header = qcow2.HEADER.pack(qcow2.MAGIC, 2, 0, 0, 16, 16 << 30)
+    disk.write_bytes(header.ljust(qcow2.HEADER_V3_OFFSET, b"\0"))
+    assert cli(["run", "--dry", "apply-disk", "-n", "data"]).exit_code == 0
+    assert "l2-cache-size=2097152,refcount-cache-size=524288" in meta.config.qemu_args
+    drive = next(a for a in meta.config.qemu_args.split() if str(disk) in a)
+    assert ",discard=unmap," in drive and "detect-zeroes" not in drive
+
+    ret = cli(["run", "--dry", "apply-disk", "-n", "raw", "--file-type=raw"] + args[5:])
+    assert isinstance(ret.exception, click.UsageError)
+
+
+@pytest.mark.offline
+def test_linked_clone(cli, fake_host, tmp_path):
+    (tmp_path / "base").mkdir()
+    base = str(tmp_path / "base" / "win.qcow2")
+    write_qcow2(base, qcow2.Info(32 << 30, 64 << 10))
+
+    def apply(name, *args):
+        ret = cli(["run", "--dry", "apply-disk", "-n", name, *args])
+        assert ret.exit_code == 0, ret.output
+        return str(next(tmp_path.glob(f"*@{name}.qcow2")))
+
+    a = apply("a", "--base=win.qcow2")
+    assert qcow2.read_info(a) == qcow2.Info(32 << 30, 64 << 10, backing_file=base)
+    b = apply("b", "--base=win.qcow2", "-s", "64G")
+    assert apply("a", "--base=win.qcow2") == a  # counted once
+    assert backing.users() == {base: [b, a]}
+    assert not os.stat(base).st_mode & 0o222
+
+    # the base is shared, b is made standalone first
+    ret = cli(["disk", "commit", "-n", "a"])
+    assert isinstance(ret.exception, EnvironmentError)
+    assert cli(["disk", "rebase", "-n", "b"]).exit_code == 0
+    assert qcow2.read_info(b).backing_file is None
+    assert cli(["disk", "commit", "-n", "a"]).exit_code == 0
+    assert ["qemu-img", "commit", "-f", "qcow2", a] in fake_host.calls
+    assert backing.users() == {base: [a]}
+
+    # a disk on another base, or on a broken chain, isn't attached
+    ret = cli(["run", "--dry", "apply-disk", "-n", "b", "--base=win.qcow2"])
+    assert "not " + base in str(ret.exception)
+    write_qcow2(b, qcow2.Info(32 << 30, 64 << 10, backing_file="missing.qcow2"))
+    ret = cli(["run", "--dry", "apply-disk", "-n", "b", "--base=win.qcow2"])
+    assert "is missing" in str(ret.exception)
+
+
+@pytest.mark.offline
+def test_share_dir(cli, fake_host, tmp_path):
+    args = ["run", "--dry", "--cpu=4", "share-dir", "-p", str(tmp_path)]
+    ret = cli(args + ["-t", "data", "--dax-window=2G", "--readonly"])
+    assert ret.exit_code == 0, ret.output
+    qemu_args = meta.config.qemu_args
+    assert "-m 128" in qemu_args  # the default, so the backend is the guest RAM
+    assert "memory-backend-memfd,id=mem,size=128M,share=on" in qemu_args
+    assert "-numa node,memdev=mem" in qemu_args
+    assert "socket,id=fs0,path=/run/virtiofsd-data.sock" in qemu_args
+    device = "vhost-user-fs-pci,chardev=fs0,tag=data,queue-size=1024,cache-size=2G"
+    assert device in qemu_args
+    start = str(next(a for a in fake_host.calls if "--shared-dir" in str(a)))
+    assert f"--shared-dir={tmp_path}" in start and "--cache=auto" in start
+    assert "--thread-pool-size=8" in start and "--readonly" in start
+
+    for tag in ["x" * 37, "../x", "a,b", "a=b", "a b", ""]:
+        ret = cli(args + ["-t", tag])
+        assert isinstance(ret.exception, click.UsageError), tag
+
+
+@pytest.mark.offline
+def test_exec_with_services(cli, fake_host, monkeypatch):
+    monkeypatch.setattr(meta, "config", meta.load_config())  # without other tests'
+    detached = []
+    monkeypatch.setattr(service, "detach", lambda s, fds: detached.extend(s))
+
+    class Exec(Exception):
+        pass
+
+    def execvp(file, argv):
+        raise Exec(argv)
+
+    monkeypatch.setattr(os, "execvp", execvp)
+    ret = cli(["run", "--cpu=2"])
+    assert isinstance(ret.exception, Exec)
+    assert ret.exception.args[0][0] == "qemu-system-x86_64"
+    assert [s.name for s in detached] == ["dhcp"]  # DHCP is on by default
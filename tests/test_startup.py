@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import main
+
+VERSION_BUDGET = 1.0  # seconds
+DRY_RUN_BUDGET = 15.0
+# heavy modules which must not be imported before a subcommand needs them
+LAZY_MODULES = ["src.run", "src.disk", "src.meta", "pydantic", "dynaconf"]
+
+
+def _python(*args):
+    return subprocess.run(
+        [sys.executable, *args], cwd=main.THIS_DIR, capture_output=True, check=True
+    )
+
+
+def _wall_time(*args):
+    start = time.perf_counter()
+    _python("main.py", *args)
+    return time.perf_counter() - start
+
+
+@pytest.mark.offline
+def test_import_time():
+    ret = _python("-X", "importtime", "-c", "import main")
+    imports = set()
+    for line in ret.stderr.decode().splitlines():
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            imports.add(name.strip())
+    assert "main" in imports
+    for module in LAZY_MODULES:
+        assert module not in imports
+
+
+@pytest.mark.skipif(
+    not os.path.exists(os.path.join(main.THIS_DIR, "version.txt")),
+    reason="version.txt not generated",
+)
+def test_version_time():
+    assert _wall_time("version") < VERSION_BUDGET
+
+
+def test_dry_run_time():
+    assert _wall_time("run", "--dry", "--no-netdev", "--no-vnc-web") < DRY_RUN_BUDGET